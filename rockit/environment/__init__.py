@@ -16,5 +16,21 @@
 
 """environmentd common code"""
 
+import importlib
 from .constants import CommandStatus
-from .config import Config
+from .client_config import ClientConfig
+
+# The daemon classes are imported on first use so that the environment client,
+# which only needs ClientConfig, doesn't pay for importing the aggregation code
+_LAZY_IMPORTS = {
+    'Config': '.config',
+    'ChangeNotifier': '.change_notifier',
+    'PollScheduler': '.poll_scheduler',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        module = importlib.import_module(_LAZY_IMPORTS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -14,13 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with rockit.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Class used for aggregating environment sensor status over a time range"""
+"""Classes used for aggregating environment sensor status over a time range"""
 
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-branches
 
-import datetime
-import statistics
+import bisect
+import calendar
+from collections import Counter, deque
+import math
+from .measurement_buffer import MeasurementBuffer
+from .timestamps import format_timestamp, NO_DATA_DATE
+
+
+def format_summary_dates(summary):
+    """Returns a copy of a summary created with epoch_dates=True with the dates formatted as strings"""
+    ret = dict(summary)
+    if summary['date_count']:
+        ret['date_start'] = format_timestamp(summary['date_start'])
+        ret['date_end'] = format_timestamp(summary['date_end'])
+    else:
+        ret['date_start'] = ret['date_end'] = NO_DATA_DATE
+    return ret
 
 
 class AggregateBehaviour:
@@ -42,11 +57,153 @@ class AggregateBehaviour:
             return cls.LatestSet
         raise ValueError('could not convert string to AggregateBehaviour: ' + value)
 
+    @classmethod
+    def label(cls, value):
+        """Returns the config string for an AggregateBehaviour"""
+        return ['Range', 'Median', 'Latest', 'Set', 'LatestSet'][value]
+
+
+class AggregateWindow:
+    """
+    Sliding window of measurements for a single parameter.
+
+    The measurements are stored in a MeasurementBuffer, and the window tracks the
+    sequence numbers of the measurements that were accepted by the parameter.
+    The summary values (range, median, set of values) are updated as measurements
+    are appended and expired so that querying them does not depend on the window size:
+      Range: monotonic deques of (sequence, value) for the min and max
+      Median: sorted list of values in the window
+      Set: reference counts for each distinct value
+    """
+    def __init__(self, behaviour, buffer, field):
+        self._behaviour = behaviour
+        self._buffer = buffer
+        self._field = field
+
+        # Sequence numbers of the measurements in the window, oldest first
+        self._sequences = deque()
+
+        self._min = deque()
+        self._max = deque()
+        self._sorted = []
+        self._counts = Counter()
+
+    def append(self, sequence):
+        """Adds the measurement with the given buffer sequence number to the end of the window"""
+        self._sequences.append(sequence)
+        value = self._buffer.value(self._field, sequence)
+
+        if self._behaviour == AggregateBehaviour.Range:
+            while self._min and self._min[-1][1] >= value:
+                self._min.pop()
+            self._min.append((sequence, value))
+
+            while self._max and self._max[-1][1] <= value:
+                self._max.pop()
+            self._max.append((sequence, value))
+        elif self._behaviour == AggregateBehaviour.Median:
+            bisect.insort(self._sorted, value)
+        elif self._behaviour == AggregateBehaviour.Set:
+            self._counts[value] += 1
+
+    def expire(self, sequence):
+        """Discards measurements with a sequence number before the given value.
+           Must be called before the measurements are discarded from the buffer"""
+        while self._sequences and self._sequences[0] < sequence:
+            self._pop()
+
+    def clear(self):
+        """Discards all measurements"""
+        self._sequences.clear()
+        self._min.clear()
+        self._max.clear()
+        self._sorted.clear()
+        self._counts.clear()
+
+    def _pop(self):
+        """Removes the oldest measurement from the window"""
+        sequence = self._sequences.popleft()
+        if self._behaviour == AggregateBehaviour.Range:
+            if self._min[0][0] == sequence:
+                self._min.popleft()
+            if self._max[0][0] == sequence:
+                self._max.popleft()
+        elif self._behaviour == AggregateBehaviour.Median:
+            value = self._buffer.value(self._field, sequence)
+            del self._sorted[bisect.bisect_left(self._sorted, value)]
+        elif self._behaviour == AggregateBehaviour.Set:
+            value = self._buffer.value(self._field, sequence)
+            self._counts[value] -= 1
+            if not self._counts[value]:
+                del self._counts[value]
+
+    def measurements(self):
+        """Returns a list of (timestamp, value) tuples for the measurements in the window"""
+        return [(self._buffer.timestamp(s), self._buffer.value(self._field, s)) for s in self._sequences]
+
+    @property
+    def count(self):
+        """Number of measurements in the window"""
+        return len(self._sequences)
+
+    @property
+    def date_start(self):
+        """Timestamp of the oldest measurement in the window"""
+        return self._buffer.timestamp(self._sequences[0])
+
+    @property
+    def date_end(self):
+        """Timestamp of the newest measurement in the window"""
+        return self._buffer.timestamp(self._sequences[-1])
+
+    @property
+    def latest(self):
+        """Value of the newest measurement in the window"""
+        return self._buffer.value(self._field, self._sequences[-1])
+
+    @property
+    def minimum(self):
+        """Minimum value in the window (Range parameters only)"""
+        return self._min[0][1]
+
+    @property
+    def maximum(self):
+        """Maximum value in the window (Range parameters only)"""
+        return self._max[0][1]
+
+    @property
+    def median(self):
+        """Median value in the window (Median parameters only)"""
+        count = len(self._sorted)
+        middle = count // 2
+        if count % 2 == 1:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2
+
+    @property
+    def values(self):
+        """Distinct values in the window (Set parameters only)"""
+        return self._counts.keys()
+
+    def next_change(self, length):
+        """
+        Time (unix timestamp) when expiring measurements from a non-empty window of the given length
+        may next change the aggregated value that is compared against the limits.
+        This is usually later than date_start + length, because a Range only changes when its min or max
+        expires and the Latest behaviours only change when the window becomes empty
+        """
+        if self._behaviour == AggregateBehaviour.Range:
+            return self._buffer.timestamp(min(self._min[0][0], self._max[0][0])) + length
+        if self._behaviour in (AggregateBehaviour.Latest, AggregateBehaviour.LatestSet):
+            return self.date_end + length
+        return self.date_start + length
+
 
 class AggregateParameter:
     """Defines the aggregation behaviour for a specific environment parameter"""
     def __init__(self, name, behaviour, label, unit=None, limits=None, warn_limits=None,
-                 valid_set_values=None, display=None, measurement_name=None, ignore_values=None):
+                 valid_set_values=None, display=None, measurement_name=None, ignore_values=None,
+                 window_length=None, query_margins=None):
         self.name = name
         self._label = label
         self._unit = unit
@@ -58,9 +215,102 @@ class AggregateParameter:
         self._ignore_values = ignore_values
         self._measurement_name = measurement_name if measurement_name is not None else name
 
+        # Overrides the watcher window length for the default status if not None
+        self.window_length = window_length
+
+        # Distances below the lower and above the upper limits where the watcher
+        # switches to its fastest query rate, or None to not affect the query rate
+        self.query_margins = query_margins
+
+    @property
+    def fields(self):
+        """Measurement fields that are used by this parameter"""
+        return [self._measurement_name]
+
+    def create_window(self, buffer):
+        """Creates an empty AggregateWindow for accumulating measurements of this parameter from a buffer"""
+        return AggregateWindow(self._behaviour, buffer, self._measurement_name)
+
+    @property
+    def filter_key(self):
+        """Hashable key that is equal for parameters that accept exactly the same measurements"""
+        return type(self), self._measurement_name, frozenset(self._ignore_values or ())
+
+    def accepts(self, measurement):
+        """Returns True if the given measurement should be included in the aggregate"""
+        if self._measurement_name not in measurement:
+            return False
+
+        # Discard any measurements that are flagged as ignored
+        # This allows "no value" measurements to be not counted as bad
+        return not self._ignore_values or measurement[self._measurement_name] not in self._ignore_values
+
+    def schema(self):
+        """
+        Static metadata for this parameter, used by clients to interpret the compact status.
+        Contains the name, type (behaviour) and label, and the unit, limits, warn_limits,
+        display and valid_values keys if these are reported by summarise()
+        """
+        ret = {
+            'name': self.name,
+            'type': AggregateBehaviour.label(self._behaviour),
+            'label': self._label
+        }
+
+        if self._unit:
+            ret['unit'] = self._unit
+
+        if self._limits:
+            ret['limits'] = self._limits
+
+        if self._warn_limits:
+            ret['warn_limits'] = self._warn_limits
+
+        if self._display and self._behaviour not in [AggregateBehaviour.Range, AggregateBehaviour.Median]:
+            ret['display'] = self._display
+
+        if self._valid_set_values and self._behaviour in [AggregateBehaviour.Set, AggregateBehaviour.LatestSet]:
+            ret['valid_values'] = list(self._valid_set_values)
+
+        return ret
+
+    @property
+    def affects_safety(self):
+        """True if the parameter defines unsafe limits or valid values"""
+        return bool(self._limits or self._valid_set_values)
+
+    def near_limits(self, value):
+        """Returns True if a numeric value is within query_margins of the unsafe or warning limits"""
+        if self.query_margins is None:
+            return False
+
+        for limits in [self._limits, self._warn_limits]:
+            if limits and (value - limits[0] < self.query_margins[0] or limits[1] - value < self.query_margins[1]):
+                return True
+        return False
+
     def aggregate(self, measurements, stale_measurement_threshold):
         """
-        Aggregated information for this measurement
+        Aggregated information for a list of measurements
+        The measurement and threshold dates are given as datetime objects
+        See summarise() for details of the returned dictionary
+        """
+        # The buffer requires measurements in time order
+        buffer = MeasurementBuffer(self.fields)
+        window = self.create_window(buffer)
+        for measurement in sorted(measurements, key=lambda m: m['date']):
+            sequence = buffer.append(calendar.timegm(measurement['date'].utctimetuple()), measurement)
+            if self.accepts(measurement):
+                window.append(sequence)
+
+        stale_timestamp = calendar.timegm(stale_measurement_threshold.utctimetuple())
+        return self.summarise(window, stale_timestamp)
+
+    def summarise(self, window, stale_measurement_threshold, epoch_dates=False):
+        """
+        Aggregated information for the measurements in an AggregateWindow.
+        stale_measurement_threshold is given as a unix timestamp.
+        If epoch_dates is True then date_start and date_end are unix timestamps (None if there is no data)
 
         Returns a dictionary of values:
            label: Short human-readable description of the measurement
@@ -83,23 +333,26 @@ class AggregateParameter:
         Note that unsafe and warning will be FALSE if there is no data for this measurement,
         so always check current and/or date_count before trying to interpret that flag
         """
-
-        # Discard any measurements that are flagged as ignored
-        # This allows "no value" measurements to be not counted as bad
-        if self._ignore_values:
-            measurements = [m for m in measurements if m[self._measurement_name] not in self._ignore_values]
-
-        measurement_start = measurements[0]['date'] if measurements else datetime.datetime.min
-        measurement_end = measurements[-1]['date'] if measurements else datetime.datetime.min
+        if window.count:
+            measurement_end = window.date_end
+            if epoch_dates:
+                date_start = window.date_start
+                date_end = measurement_end
+            else:
+                date_start = format_timestamp(window.date_start)
+                date_end = format_timestamp(measurement_end)
+        else:
+            measurement_end = -math.inf
+            date_start = date_end = None if epoch_dates else NO_DATA_DATE
 
         ret = {
             'label': self._label,
             'unsafe': False,
             'warning': False,
             'current': measurement_end >= stale_measurement_threshold,
-            'date_start': measurement_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'date_end': measurement_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'date_count' : len(measurements),
+            'date_start': date_start,
+            'date_end': date_end,
+            'date_count' : window.count,
         }
 
         if self._unit:
@@ -111,59 +364,20 @@ class AggregateParameter:
         if self._warn_limits:
             ret['warn_limits'] = self._warn_limits
 
-        if not measurements:
+        if not window.count:
             return ret
 
         if self._behaviour == AggregateBehaviour.Range:
-            ret['min'] = ret['max'] = measurements[0][self._measurement_name]
-            for measurement in measurements:
-                value = measurement[self._measurement_name]
-                ret['min'] = min(value, ret['min'])
-                ret['max'] = max(value, ret['max'])
-                ret['latest'] = value
-
-            if self._limits:
-                ret['unsafe'] = ret['min'] < self._limits[0] or ret['max'] > self._limits[1]
-
-            if self._warn_limits:
-                ret['warning'] = ret['min'] < self._warn_limits[0] \
-                    or ret['max'] > self._warn_limits[1]
-
+            ret['min'] = window.minimum
+            ret['max'] = window.maximum
+            ret['latest'] = window.latest
         elif self._behaviour == AggregateBehaviour.Median:
-            ret['latest'] = statistics.median([m[self._measurement_name] for m in measurements])
-            if self._limits:
-                ret['unsafe'] = ret['latest'] < self._limits[0] or ret['latest'] > self._limits[1]
-
-            if self._warn_limits:
-                ret['warning'] = ret['latest'] < self._warn_limits[0] \
-                    or ret['latest'] > self._warn_limits[1]
-
+            ret['latest'] = window.median
         elif self._behaviour == AggregateBehaviour.Set:
-            ret['latest'] = measurements[-1][self._measurement_name]
-
-            # Convert to a set to remove duplicates
-            values = {m[self._measurement_name] for m in measurements}
-
-            # Convert back to a list so it can be serialized as json
-            ret['values'] = list(values)
-
-            if self._display:
-                ret['display'] = self._display
-
-            if self._valid_set_values:
-                ret['valid_values'] = list(self._valid_set_values)
-
-                # If all values are valid the set difference against _valid_set_values will be empty
-                ret['unsafe'] = ret['warning'] = bool(values - self._valid_set_values)
-
-        elif self._behaviour == AggregateBehaviour.Set:
-            ret['latest'] = measurements[-1][self._measurement_name]
-
-            # Convert to a set to remove duplicates
-            values = {m[self._measurement_name] for m in measurements}
+            ret['latest'] = window.latest
 
             # Convert back to a list so it can be serialized as json
-            ret['values'] = list(values)
+            ret['values'] = list(window.values)
 
             if self._display:
                 ret['display'] = self._display
@@ -171,35 +385,74 @@ class AggregateParameter:
             if self._valid_set_values:
                 ret['valid_values'] = list(self._valid_set_values)
 
-                # If all values are valid the set difference against _valid_set_values will be empty
-                ret['unsafe'] = ret['warning'] = bool(values - self._valid_set_values)
         elif self._behaviour == AggregateBehaviour.LatestSet:
-            ret['latest'] = measurements[-1][self._measurement_name]
+            ret['latest'] = window.latest
 
             if self._display:
                 ret['display'] = self._display
 
             if self._valid_set_values:
                 ret['valid_values'] = list(self._valid_set_values)
-                ret['unsafe'] = ret['warning'] = ret['latest'] not in self._valid_set_values
         else:  # AggregateBehaviour.Latest
-            ret['latest'] = measurements[-1][self._measurement_name]
+            ret['latest'] = window.latest
 
             if self._display:
                 ret['display'] = self._display
 
-            if self._limits and ret['current']:
-                ret['unsafe'] = ret['latest'] < self._limits[0] or ret['latest'] > self._limits[1]
+        ret['unsafe'], ret['warning'] = self.limit_flags(window, ret['current'])
+        return ret
 
-            if self._warn_limits and ret['current']:
-                ret['warning'] = ret['latest'] < self._warn_limits[0] or ret['latest'] > self._warn_limits[1]
+    def limit_flags(self, window, current):
+        """Returns a tuple of the (unsafe, warning) flags for the measurements in a non-empty AggregateWindow.
+           This is the part of summarise that determines safety, without building the summary dictionary"""
+        if self._behaviour in (AggregateBehaviour.Range, AggregateBehaviour.Median):
+            if self._behaviour == AggregateBehaviour.Range:
+                low, high = window.minimum, window.maximum
+            else:
+                low = high = window.median
 
-        return ret
+            unsafe = bool(self._limits) and (low < self._limits[0] or high > self._limits[1])
+            warning = bool(self._warn_limits) and (low < self._warn_limits[0] or high > self._warn_limits[1])
+            return unsafe, warning
+
+        if self._behaviour == AggregateBehaviour.Set:
+            # Unsafe if any of the values seen in the window are not valid
+            unsafe = bool(self._valid_set_values) and any(v not in self._valid_set_values for v in window.values)
+            return unsafe, unsafe
+
+        if self._behaviour == AggregateBehaviour.LatestSet:
+            unsafe = bool(self._valid_set_values) and window.latest not in self._valid_set_values
+            return unsafe, unsafe
+
+        # AggregateBehaviour.Latest only applies limits to current measurements
+        if not current:
+            return False, False
+
+        latest = window.latest
+        unsafe = bool(self._limits) and (latest < self._limits[0] or latest > self._limits[1])
+        warning = bool(self._warn_limits) and (latest < self._warn_limits[0] or latest > self._warn_limits[1])
+        return unsafe, warning
 
 
 class FilterInvalidAggregateParameter(AggregateParameter):
     """AggregateParameter subclass for parameters that are paired with a _valid flag"""
-    def aggregate(self, measurements, stale_measurement_threshold):
-        """Aggregates after discarding measurements that are not valid for this parameter"""
-        measurements = [m for m in measurements if m[self._measurement_name + '_valid']]
-        return super().aggregate(measurements, stale_measurement_threshold)
+    @property
+    def fields(self):
+        """Measurement fields that are used by this parameter"""
+        return [self._measurement_name, self._measurement_name + '_valid']
+
+    def accepts(self, measurement):
+        """Discards measurements that are not valid for this parameter"""
+        return measurement.get(self._measurement_name + '_valid', False) and super().accepts(measurement)
+
+
+def filter_groups(parameters):
+    """
+    Groups the indices of parameters that accept the same measurements, so that
+    accepts() only needs to be evaluated once per group for each measurement.
+    Returns a list of (parameter, [indices]) tuples
+    """
+    groups = {}
+    for i, parameter in enumerate(parameters):
+        groups.setdefault(parameter.filter_key, (parameter, []))[1].append(i)
+    return list(groups.values())
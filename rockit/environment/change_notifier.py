@@ -0,0 +1,106 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Class used for notifying clients of changes to the aggregated status"""
+
+from collections import OrderedDict
+import threading
+
+# Parameter keys that are reported in a status delta
+DELTA_KEYS = ['unsafe', 'warning', 'current', 'latest']
+
+
+def status_delta(old, new):
+    """
+    Compares two aggregated status dictionaries and returns a dictionary of
+    {watcher: {parameter: {unsafe, warning, current, latest}}} for the parameters
+    where any of these values have changed. Watchers and parameters that have been removed
+    (e.g. by reloading the config) are reported as None
+    """
+    changes = {}
+    for watcher, watcher_status in new.items():
+        old_parameters = old.get(watcher, {}).get('parameters', {})
+        for name, parameter in watcher_status['parameters'].items():
+            previous = old_parameters.get(name)
+            if previous is None or any(previous.get(k) != parameter.get(k) for k in DELTA_KEYS):
+                changes.setdefault(watcher, {})[name] = {k: parameter[k] for k in DELTA_KEYS if k in parameter}
+
+        for name in old_parameters:
+            if name not in watcher_status['parameters']:
+                changes.setdefault(watcher, {})[name] = None
+
+    for watcher in old:
+        if watcher not in new:
+            changes[watcher] = None
+
+    return changes
+
+
+class ChangeNotifier:
+    """
+    Wakes threads that are waiting for the watchers to publish new data,
+    and keeps the recent versions of the aggregated status so that changes
+    can be reported as a delta against a version that a client already has.
+    """
+    def __init__(self, history_length=64):
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._history_length = history_length
+        self._history = OrderedDict()
+
+    @property
+    def generation(self):
+        """Counter that increases every time notify() is called"""
+        with self._condition:
+            return self._generation
+
+    def notify(self):
+        """Wakes all threads that are blocked in wait()"""
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Blocks until notify() has been called since generation was read, or timeout seconds have passed"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+    def record(self, version, status):
+        """Stores an aggregated status so that it can be used as the base for later deltas"""
+        with self._condition:
+            if version not in self._history:
+                self._history[version] = status
+                while len(self._history) > self._history_length:
+                    self._history.popitem(last=False)
+
+    def delta(self, since_version, version, status):
+        """
+        Returns a dictionary describing the changes between since_version and the given status.
+        If since_version is no longer known then the full status is returned instead
+        """
+        with self._condition:
+            previous = self._history.get(since_version)
+
+        if previous is None:
+            return {
+                'version': version,
+                'status': status
+            }
+
+        return {
+            'version': version,
+            'changes': status_delta(previous, status)
+        }
@@ -0,0 +1,38 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lightweight config loading for the environment commandline client"""
+
+import json
+from rockit.common import daemons
+
+
+class ClientConfig:
+    """
+    The subset of the environmentd configuration that is needed by clients.
+    Only the daemon entry is read: the schema validation and watcher construction
+    performed by Config are skipped, because the daemon itself validates the file
+    """
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    @classmethod
+    def load(cls, config_filename):
+        """Returns the ClientConfig for a config file"""
+        with open(config_filename, 'r', encoding='utf-8') as config_file:
+            config_json = json.load(config_file)
+
+        return cls(getattr(daemons, config_json['daemon']))
@@ -0,0 +1,126 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Functions for converting between the aggregated status dictionaries and the compact
+encoding returned by status_compact().
+
+The static parameter metadata (labels, units, limits, etc) is sent once by status_schema(),
+and the compact status contains only the dynamic values for each parameter as a list with
+the fields in COMPACT_FIELDS order. Trailing fields that are None are omitted.
+The parameter lists are grouped by watcher in the order given by the schema.
+"""
+
+# Order of the values in each compact parameter row
+COMPACT_FIELDS = ['flags', 'date_start', 'date_end', 'date_count', 'latest', 'min', 'max', 'values']
+
+# Bits used in the flags field
+FLAG_UNSAFE = 1
+FLAG_WARNING = 2
+FLAG_CURRENT = 4
+
+# Metadata keys that are included in every status summary where they are defined
+SCHEMA_KEYS = ['unit', 'limits', 'warn_limits']
+
+# Metadata keys that are only included in status summaries that contain data
+SCHEMA_DATA_KEYS = ['display', 'valid_values']
+
+
+def encode_parameter(summary):
+    """Converts a parameter summary created with epoch_dates=True to a compact row"""
+    flags = 0
+    if summary['unsafe']:
+        flags |= FLAG_UNSAFE
+    if summary['warning']:
+        flags |= FLAG_WARNING
+    if summary['current']:
+        flags |= FLAG_CURRENT
+
+    row = [flags, summary['date_start'], summary['date_end'], summary['date_count'],
+           summary.get('latest'), summary.get('min'), summary.get('max'), summary.get('values')]
+
+    while row[-1] is None:
+        row.pop()
+    return row
+
+
+def encode_status(status):
+    """Converts an aggregated status dictionary created with epoch_dates=True to a list of compact rows"""
+    return [[encode_parameter(p) for p in watcher_status['parameters'].values()]
+            for watcher_status in status.values()]
+
+
+def status_changes(old, new):
+    """Returns a list of [watcher index, parameter index, row] for the rows that differ between two
+       compact status lists that were encoded with the same schema"""
+    return [[i, j, row]
+            for i, (old_rows, new_rows) in enumerate(zip(old, new))
+            for j, (old_row, row) in enumerate(zip(old_rows, new_rows))
+            if row != old_row]
+
+
+def apply_status_changes(rows, changes):
+    """Returns a copy of a compact status list updated with the output of status_changes()"""
+    rows = [list(watcher_rows) for watcher_rows in rows]
+    for i, j, row in changes:
+        rows[i][j] = row
+    return rows
+
+
+def decode_parameter(schema, row):
+    """Converts a compact row back to the parameter summary returned by status(epoch_dates=True)"""
+    row = list(row) + [None] * (len(COMPACT_FIELDS) - len(row))
+    flags, date_start, date_end, date_count, latest, minimum, maximum, values = row
+    ret = {
+        'label': schema['label'],
+        'unsafe': bool(flags & FLAG_UNSAFE),
+        'warning': bool(flags & FLAG_WARNING),
+        'current': bool(flags & FLAG_CURRENT),
+        'date_start': date_start,
+        'date_end': date_end,
+        'date_count': date_count,
+    }
+
+    for key in SCHEMA_KEYS:
+        if key in schema:
+            ret[key] = schema[key]
+
+    if not date_count:
+        return ret
+
+    ret['latest'] = latest
+    if schema['type'] == 'Range':
+        ret['min'] = minimum
+        ret['max'] = maximum
+    elif schema['type'] == 'Set':
+        ret['values'] = values
+
+    for key in SCHEMA_DATA_KEYS:
+        if key in schema:
+            ret[key] = schema[key]
+
+    return ret
+
+
+def decode_status(schema, rows):
+    """Converts a compact status list back to the dictionary returned by status(epoch_dates=True)"""
+    status = {}
+    for watcher, watcher_rows in zip(schema['watchers'], rows):
+        status[watcher['name']] = {
+            'label': watcher['label'],
+            'parameters': {p['name']: decode_parameter(p, r) for p, r in zip(watcher['parameters'], watcher_rows)}
+        }
+    return status
@@ -17,10 +17,112 @@
 """Helper function to validate and parse the json config file"""
 
 import json
+import os
 from rockit.common import daemons, IP, validation
 
 from .aggregate_parameter import AggregateBehaviour, AggregateParameter, FilterInvalidAggregateParameter
+from .derived_watcher import DerivedExpression, DerivedWatcher
+from .proxy_pool import ProxyPool
 from .pyro_watcher import PyroWatcher
+from .worker_pool import WorkerPool
+
+PARAMETER_SCHEMA = {
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['label', 'type'],
+    'properties': {
+        'label': {
+            'type': 'string',
+        },
+        'unit': {
+            'type': 'string',
+        },
+        'type': {
+            'type': 'string',
+            # These must also be defined in the 'anyOf' cases below
+            'enum': ['Range', 'Median', 'Latest', 'Set', 'LatestSet']
+        },
+        'filter_invalid': {
+            'type': 'boolean'
+        },
+        'window_length': {
+            'type': 'number',
+            'minimum': 1,
+            'maximum': 86400
+        },
+        'warn_limits': {
+            'type': 'array',
+            'maxItems': 2,
+            'minItems': 2,
+            'items': {
+                'type': 'number'
+            }
+        },
+        'unsafe_limits': {
+            'type': 'array',
+            'maxItems': 2,
+            'minItems': 2,
+            'items': {
+                'type': 'number'
+            }
+        },
+        'query_margins': {
+            'type': 'array',
+            'maxItems': 2,
+            'minItems': 2,
+            'items': {
+                'type': 'number',
+                'minimum': 0
+            }
+        },
+        'display': {
+            'type': 'string',
+            'enum': ['UPSStatus', 'BoolClosedOpen', 'BoolSafeTripped',
+                     'BoolHealthyUnhealthy', 'BoolPowerOnOff', 'DiskBytes']
+        },
+        # Only used if type: Median
+        'median_key': {
+            'type': 'string'
+        },
+
+        # Only used if type: Set, LatestSet
+        'valid_set_values': {
+            'type': 'array'
+        }
+    },
+    # Require 'median_key' if 'type' is a median
+    'anyOf': [
+        {
+            'properties': {
+                'type': {
+                    'enum': ['Median']
+                }
+            },
+            'required': ['median_key']
+        },
+        {
+            'properties': {
+                'type': {
+                    'enum': ['Set', 'Range', 'Latest', 'LatestSet']
+                }
+            }
+        }
+    ]
+}
+
+# Derived parameters are calculated from an expression instead of being read from a measurement field
+DERIVED_PARAMETER_SCHEMA = {
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['label', 'type', 'expression'],
+    'properties': {
+        **{k: v for k, v in PARAMETER_SCHEMA['properties'].items()
+           if k not in ['filter_invalid', 'median_key', 'query_margins']},
+        'expression': {
+            'type': 'string'
+        }
+    }
+}
 
 CONFIG_SCHEMA = {
     'type': 'object',
@@ -39,6 +141,30 @@ CONFIG_SCHEMA = {
             'minimum': 1,
             'maximum': 86400
         },
+        'additional_windows': {
+            'type': 'array',
+            'items': {
+                'type': 'number',
+                'minimum': 1,
+                'maximum': 86400
+            }
+        },
+        'max_concurrent_queries': {
+            'type': 'integer',
+            'minimum': 1,
+            'maximum': 256
+        },
+        'history_path': {
+            'type': 'string'
+        },
+        'persistent_connections': {
+            'type': 'boolean'
+        },
+        'worker_processes': {
+            'type': 'integer',
+            'minimum': 0,
+            'maximum': 256
+        },
         'control_machines': {
             'type': 'array',
             'items': {
@@ -68,6 +194,16 @@ CONFIG_SCHEMA = {
                         'minimum': 1,
                         'maximum': 86400
                     },
+                    'min_query_rate': {
+                        'type': 'number',
+                        'minimum': 1,
+                        'maximum': 86400
+                    },
+                    'max_query_rate': {
+                        'type': 'number',
+                        'minimum': 1,
+                        'maximum': 86400
+                    },
                     'stale_age': {
                         'type': 'number',
                         'minimum': 1,
@@ -75,78 +211,58 @@ CONFIG_SCHEMA = {
                     },
                     'parameters': {
                         'type': 'object',
-                        'additionalProperties': {
-                            'type': 'object',
-                            'additionalProperties': False,
-                            'required': ['label', 'type'],
-                            'properties': {
-                                'label': {
-                                    'type': 'string',
-                                },
-                                'unit': {
-                                    'type': 'string',
-                                },
-                                'type': {
-                                    'type': 'string',
-                                    # These must also be defined in the 'anyOf' cases below
-                                    'enum': ['Range', 'Median', 'Latest', 'Set', 'LatestSet']
-                                },
-                                'filter_invalid': {
-                                    'type': 'boolean'
-                                },
-                                'warn_limits': {
-                                    'type': 'array',
-                                    'maxItems': 2,
-                                    'minItems': 2,
-                                    'items': {
-                                        'type': 'number'
-                                    }
-                                },
-                                'unsafe_limits': {
-                                    'type': 'array',
-                                    'maxItems': 2,
-                                    'minItems': 2,
-                                    'items': {
-                                        'type': 'number'
-                                    }
-                                },
-                                'display': {
-                                    'type': 'string',
-                                    'enum': ['UPSStatus', 'BoolClosedOpen', 'BoolSafeTripped',
-                                             'BoolHealthyUnhealthy', 'BoolPowerOnOff', 'DiskBytes']
-                                },
-                                # Only used if type: Median
-                                'median_key': {
-                                    'type': 'string'
-                                },
-
-                                # Only used if type: Set, LatestSet
-                                'valid_set_values': {
-                                    'type': 'array'
-                                }
-                            },
-                            # Require 'median_key' if 'type' is a median
-                            'anyOf': [
-                                {
-                                    'properties': {
-                                        'type': {
-                                            'enum': ['Median']
-                                        }
-                                    },
-                                    'required': ['median_key']
-                                },
-                                {
-                                    'properties': {
-                                        'type': {
-                                            'enum': ['Set', 'Range', 'Latest', 'LatestSet']
-                                        }
-                                    }
-                                }
-                            ]
+                        'additionalProperties': PARAMETER_SCHEMA
+                    }
+                }
+            }
+        },
+        'safety_groups': {
+            'type': 'object',
+            'additionalProperties': {
+                'type': 'object',
+                'additionalProperties': False,
+                'properties': {
+                    'required': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'string'
+                        }
+                    },
+                    'optional': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'string'
                         }
                     }
                 }
             }
+        },
+        'derived_watchers': {
+            'type': 'object',
+            'additionalProperties': {
+                'type': 'object',
+                'additionalProperties': False,
+                'required': ['label', 'query_rate', 'stale_age', 'parameters'],
+                'properties': {
+                    'label': {
+                        'type': 'string',
+                    },
+                    'query_rate': {
+                        'type': 'number',
+                        'minimum': 1,
+                        'maximum': 86400
+                    },
+                    'stale_age': {
+                        'type': 'number',
+                        'minimum': 1,
+                        'maximum': 86400
+                    },
+                    'parameters': {
+                        'type': 'object',
+                        'additionalProperties': DERIVED_PARAMETER_SCHEMA
+                    }
+                }
+            }
         }
     }
 }
@@ -171,13 +287,26 @@ def parse_watcher_parameter(parameter, parameter_json):
     warn_limits = parameter_json.get('warn_limits', None)
     unit = parameter_json.get('unit', None)
     display = parameter_json.get('display', None)
+    window_length = parameter_json.get('window_length', None)
+    query_margins = parameter_json.get('query_margins', None)
 
     return parameter_type(parameter, behaviour, parameter_json['label'], unit=unit,
                           limits=limits,
                           warn_limits=warn_limits,
                           measurement_name=median_key,
                           valid_set_values=valid_set_values,
-                          display=display)
+                          display=display,
+                          window_length=window_length,
+                          query_margins=query_margins)
+
+
+class WatcherReloadError(Exception):
+    """Raised when Config.reload_watchers fails and the previous watchers have been restored.
+       watchers is the restored watcher list and removed lists the previous watchers that it no longer contains"""
+    def __init__(self, message, watchers, removed):
+        super().__init__(message)
+        self.watchers = watchers
+        self.removed = removed
 
 
 class Config:
@@ -193,28 +322,240 @@ class Config:
             'machine_name': validation.machine_name_validator,
         })
 
+        self.filename = config_filename
+        self._proxy_pool = None
+
+        # WorkerPool that runs the (non-derived) watchers if worker_processes is greater than 0
+        self.worker_pool = None
+
         self.daemon = getattr(daemons, config_json['daemon'])
         self.log_name = config_json['log_name']
         self.control_ips = [getattr(IP, machine) for machine in config_json['control_machines']]
         self.window_length = config_json['window_length']
+        self.max_concurrent_queries = config_json.get('max_concurrent_queries', 8)
+        self.persistent_connections = config_json.get('persistent_connections', False)
+        self.history_path = config_json.get('history_path', None)
+        self.worker_processes = config_json.get('worker_processes', 0)
 
         self.watcher_config = []
         for watcher, watcher_json in config_json['watchers'].items():
+            query_rate = watcher_json['query_rate']
+            min_query_rate = watcher_json.get('min_query_rate', query_rate)
+            max_query_rate = watcher_json.get('max_query_rate', query_rate)
+            if not min_query_rate <= query_rate <= max_query_rate:
+                raise ValueError(f'watcher {watcher} must satisfy min_query_rate <= query_rate <= max_query_rate')
+
+            # Measurements would go stale between queries, making the watcher report no data
+            if max_query_rate >= watcher_json['stale_age']:
+                raise ValueError(f'watcher {watcher} must satisfy max_query_rate (or query_rate) < stale_age')
+
             self.watcher_config.append({
                 'name': watcher,
                 'daemon': getattr(daemons, watcher_json['daemon']),
                 'method': watcher_json['method'],
                 'label': watcher_json['label'],
+                'query_rate': query_rate,
+                'min_query_rate': min_query_rate,
+                'max_query_rate': max_query_rate,
+                'stale_age': watcher_json['stale_age'],
+                'parameters': [parse_watcher_parameter(k, v) for (k, v) in watcher_json['parameters'].items()],
+                'json': watcher_json
+            })
+
+        # Expressions are compiled here so that errors are reported when the config is loaded
+        self.derived_watcher_config = []
+        for watcher, watcher_json in config_json.get('derived_watchers', {}).items():
+            if watcher in config_json['watchers']:
+                raise ValueError(f'derived watcher {watcher} has the same name as a watcher')
+
+            self.derived_watcher_config.append({
+                'name': watcher,
+                'label': watcher_json['label'],
                 'query_rate': watcher_json['query_rate'],
                 'stale_age': watcher_json['stale_age'],
-                'parameters': [parse_watcher_parameter(k, v) for (k, v) in watcher_json['parameters'].items()]
+                'parameters': [parse_watcher_parameter(k, v) for (k, v) in watcher_json['parameters'].items()],
+                'expressions': [DerivedExpression(v['expression'], config_json['watchers'])
+                                for v in watcher_json['parameters'].values()],
+                'json': watcher_json
             })
 
+        # Every watcher aggregates over all of the window lengths that are used anywhere in the config
+        window_lengths = {self.window_length}
+        window_lengths.update(config_json.get('additional_windows', []))
+        for watcher in self.watcher_config + self.derived_watcher_config:
+            window_lengths.update(p.window_length for p in watcher['parameters'] if p.window_length)
+        self.window_lengths = sorted(window_lengths)
+
+        # Groups of watchers that determine whether it is safe to observe (see EnvironmentDaemon.safe)
+        watcher_names = {w['name'] for w in self.watcher_config + self.derived_watcher_config}
+        self.safety_groups = {}
+        for group, group_json in config_json.get('safety_groups', {}).items():
+            required = group_json.get('required', [])
+            optional = group_json.get('optional', [])
+            for watcher in required + optional:
+                if watcher not in watcher_names:
+                    raise ValueError(f'safety group {group} references unknown watcher {watcher}')
+
+            self.safety_groups[group] = {
+                'required': required,
+                'optional': optional
+            }
+
     def get_watchers(self):
-        """Returns a list of PyroWatchers to be monitored"""
+        """Returns a list of PyroWatchers (followed by DerivedWatchers) to be monitored.
+           If worker_processes is greater than 0 the PyroWatchers are run in a WorkerPool
+           and ShardedWatchers are returned in their place.
+           Measurements are restored from the on-disk history if history_path is configured"""
+        if self.history_path is not None:
+            os.makedirs(self.history_path, exist_ok=True)
+
+        if self.worker_processes > 0:
+            self.worker_pool = WorkerPool(self.worker_processes, self.max_concurrent_queries,
+                                          self.persistent_connections, self.log_name)
+        else:
+            self._proxy_pool = ProxyPool() if self.persistent_connections else None
+
+        return self._create_watchers({})
+
+    def reload_watchers(self, previous, watchers):
+        """
+        Applies this config to the watchers that were created from a previous Config.
+        Watchers that query the same daemon and method at the same rates keep their buffered
+        measurements, and are reconfigured in place if their parameters or window lengths have changed.
+        The other watchers are created, and the proxy pool, worker pool and history path
+        of the previous config are kept.
+        Returns a tuple of the new watcher list and a list of the previous watchers that are no longer used.
+
+        If a watcher can't be reconfigured or created the changes are undone, recreating any previous
+        watchers that had already been closed, and WatcherReloadError is raised with the restored watchers
+        """
+        self._proxy_pool = previous._proxy_pool  # pylint: disable=protected-access
+        self.worker_pool = previous.worker_pool
+        self.persistent_connections = previous.persistent_connections
+        self.history_path = previous.history_path
+        self.worker_processes = previous.worker_processes
+
+        existing = {w.daemon_name: w for w in watchers}
+        previous_config = {c['name']: c for c in previous.watcher_config}
+        previous_derived_config = {c['name']: c for c in previous.derived_watcher_config}
+        windows_changed = previous.window_length != self.window_length or \
+            previous.window_lengths != self.window_lengths
+
+        reused, changed = {}, []
+        for config in self.watcher_config:
+            old = previous_config.get(config['name'])
+            watcher = existing.get(config['name'])
+            if old is None or watcher is None:
+                continue
+
+            if any(old['json'].get(k) != config['json'].get(k) for k in
+                   ['daemon', 'method', 'query_rate', 'min_query_rate', 'max_query_rate']):
+                continue
+
+            if windows_changed or old['json'] != config['json']:
+                changed.append((watcher, old, config))
+            reused[config['name']] = watcher
+
+        # Derived watchers are only kept if they are unchanged. New ones are re-evaluated from their inputs
+        for config in self.derived_watcher_config:
+            old = previous_derived_config.get(config['name'])
+            watcher = existing.get(config['name'])
+            if old is not None and watcher is not None and not windows_changed and old['json'] == config['json']:
+                reused[config['name']] = watcher
+
+        removed = [w for w in watchers if reused.get(w.daemon_name) is not w]
+        reconfigured, closed, created = [], [], []
+        try:
+            for watcher, old, config in changed:
+                reconfigured.append((watcher, old))
+                watcher.reconfigure(config['label'], config['stale_age'], self.window_length,
+                                    config['parameters'], self.window_lengths)
+
+            for watcher in removed:
+                closed.append(watcher)
+                watcher.close()
+
+            return self._create_watchers(reused, created), removed
+        except Exception as exception:
+            # pylint: disable=protected-access
+            restored = previous._restore_watchers(watchers, reconfigured, closed, created)
+            raise WatcherReloadError(str(exception), restored,
+                                     [w for w in watchers if not any(w is r for r in restored)]) from exception
+
+    def _restore_watchers(self, watchers, reconfigured, closed, created):
+        """Undoes a failed reload_watchers, returning the watchers that should be monitored in its place.
+           Watchers that were created are closed, reconfigured watchers are reconfigured back to this config
+           and watchers that were closed are recreated"""
+        for watcher in created:
+            try:
+                watcher.close()
+            except Exception as exception:
+                print(f'ERROR: failed to close watcher {watcher.daemon_name}: {exception}')
+
+        for watcher, config in reconfigured:
+            try:
+                watcher.reconfigure(config['label'], config['stale_age'], self.window_length,
+                                    config['parameters'], self.window_lengths)
+            except Exception as exception:
+                print(f'ERROR: failed to restore watcher {watcher.daemon_name}: {exception}')
+
+        remaining = [w for w in watchers if not any(w is c for c in closed)]
+        try:
+            return self._create_watchers({w.daemon_name: w for w in remaining})
+        except Exception as exception:
+            print(f'ERROR: failed to recreate closed watchers: {exception}')
+            return remaining
+
+    def _create_watchers(self, reused, created=None):
+        """Returns a list of PyroWatchers followed by DerivedWatchers,
+           taking existing watchers from the reused dictionary of {name: watcher}.
+           Newly created watchers are also appended to created (if given) as they are created,
+           so that they can be closed if a later watcher fails"""
+        def track(watcher):
+            if created is not None:
+                created.append(watcher)
+            return watcher
+
+        def restore_history(watcher):
+            try:
+                restored = watcher.load_history()
+                if restored:
+                    print(f'Restored {restored} measurements for {watcher.daemon_name}')
+            except Exception as exception:
+                print(f'ERROR: failed to restore history for {watcher.daemon_name}: {exception}')
+
+            return watcher
+
         def create_watcher(config):
-            return PyroWatcher(config['name'], config['daemon'], config['method'], config['label'],
-                               config['query_rate'], config['stale_age'], self.window_length,
-                               config['parameters'], self.log_name)
+            if config['name'] in reused:
+                return reused[config['name']]
+
+            if self.worker_pool is not None:
+                return track(self.worker_pool.create_watcher(config['name'], config['json']['daemon'], config['method'],
+                                                       config['label'], config['query_rate'], config['stale_age'],
+                                                       self.window_length, config['parameters'], self.log_name,
+                                                       self.window_lengths, self.history_path,
+                                                       config['min_query_rate'], config['max_query_rate']))
+
+            watcher = PyroWatcher(config['name'], config['daemon'], config['method'], config['label'],
+                                  config['query_rate'], config['stale_age'], self.window_length,
+                                  config['parameters'], self.log_name, self._proxy_pool,
+                                  self.window_lengths, self.history_path,
+                                  config['min_query_rate'], config['max_query_rate'])
+            return restore_history(track(watcher))
+
+        def create_derived_watcher(config, sources):
+            if config['name'] in reused:
+                watcher = reused[config['name']]
+                watcher.set_sources(sources)
+                return watcher
+
+            watcher = DerivedWatcher(config['name'], config['label'], config['query_rate'], config['stale_age'],
+                                     self.window_length, config['parameters'], config['expressions'],
+                                     self.log_name, self.window_lengths, self.history_path)
+            watcher.set_sources(sources)
+            return restore_history(track(watcher))
 
-        return [create_watcher(w) for w in self.watcher_config]
+        watchers = [create_watcher(w) for w in self.watcher_config]
+        sources = {w.daemon_name: w for w in watchers}
+        return watchers + [create_derived_watcher(w, sources) for w in self.derived_watcher_config]
@@ -24,10 +24,12 @@ class CommandStatus:
 
     InvalidWatcher = 11
     InvalidParameter = 12
+    InvalidConfig = 13
 
     _messages = {
         # General error codes
         10: 'error: command not accepted from this IP',
+        13: 'error: failed to reload config file',
         -100: 'error: terminated by user',
         -101: 'error: unable to communicate with environment daemon'
     }
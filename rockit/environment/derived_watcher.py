@@ -0,0 +1,198 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Classes used for aggregating parameters that are calculated from the measurements of other watchers"""
+
+# pylint: disable=too-many-arguments
+
+import ast
+import math
+import time
+from .pyro_watcher import PyroWatcher
+
+# Functions that may be called from a derived parameter expression
+EXPRESSION_FUNCTIONS = {
+    'abs': abs,
+    'min': min,
+    'max': max,
+    'round': round,
+    'any': any,
+    'all': all,
+    'sqrt': math.sqrt,
+    'exp': math.exp,
+    'log': math.log,
+    'log10': math.log10,
+}
+
+# Syntax that may be used in a derived parameter expression
+EXPRESSION_NODES = (
+    ast.Expression, ast.Load, ast.Constant, ast.Name, ast.Attribute, ast.Call, ast.List, ast.Tuple,
+    ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd, ast.IfExp,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+
+class _MeasurementFields:
+    """Exposes the fields of a measurement dictionary as attributes for expression evaluation"""
+    def __init__(self, measurement):
+        self._measurement = measurement
+
+    def __getattr__(self, field):
+        return self._measurement[field]
+
+
+class DerivedExpression:
+    """
+    Arithmetic / logical expression over the measurement fields of one or more watchers.
+    Fields are referenced as watcher_name.field_name, e.g. 'vaisala.temperature - vaisala.dew_point'.
+
+    The expression is parsed and checked against a whitelist of syntax and functions
+    when the config is loaded, and compiled so that it is cheap to evaluate for each measurement.
+    """
+    def __init__(self, expression, watchers):
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as exception:
+            raise ValueError(f'invalid expression {expression!r}: {exception.msg}') from exception
+
+        functions = set()
+        referenced = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, EXPRESSION_NODES):
+                raise ValueError(f'invalid expression {expression!r}: {type(node).__name__} is not supported')
+
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in EXPRESSION_FUNCTIONS or node.keywords:
+                    raise ValueError(f'invalid expression {expression!r}: unsupported function call')
+                functions.add(node.func)
+            elif isinstance(node, ast.Attribute):
+                if not isinstance(node.value, ast.Name) or node.value.id not in watchers:
+                    raise ValueError(f'invalid expression {expression!r}: fields must be given as watcher.field ' +
+                                     'where watcher is the name of a configured watcher')
+                if node.attr.startswith('_'):
+                    raise ValueError(f'invalid expression {expression!r}: invalid field name {node.attr}')
+                referenced.add(node.value)
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node not in functions and node not in referenced:
+                raise ValueError(f'invalid expression {expression!r}: unknown name {node.id}')
+
+        self.expression = expression
+        self.watchers = sorted({node.id for node in referenced})
+        self._code = compile(tree, '<expression>', 'eval')
+
+    def evaluate(self, measurements):
+        """
+        Evaluates the expression for a dictionary of {watcher name: measurement dictionary}.
+        Returns None if a referenced field is missing or the expression can't be evaluated (e.g. log(0))
+        """
+        namespace = dict(EXPRESSION_FUNCTIONS)
+        for watcher in self.watchers:
+            if watcher not in measurements:
+                return None
+            namespace[watcher] = _MeasurementFields(measurements[watcher])
+
+        try:
+            # pylint: disable=eval-used
+            return eval(self._code, {'__builtins__': {}}, namespace)
+            # pylint: enable=eval-used
+        except (KeyError, ArithmeticError, TypeError, ValueError):
+            return None
+
+
+class DerivedWatcher(PyroWatcher):
+    """
+    Aggregates parameters that are calculated from the latest measurements of other watchers.
+
+    Each poll checks whether the input watchers have received new measurements, and only the
+    expressions that depend on those watchers are re-evaluated. Each result is ingested as a separate
+    measurement with the timestamp of the oldest input of its expression, so that a derived parameter
+    goes stale when any of its own inputs do, and is then aggregated with the usual behaviours and limits.
+    Each parameter has its own measurement buffer, so that an old input of one expression doesn't
+    affect the timestamps of the other parameters.
+    """
+    def __init__(self, daemon_name, label, query_delay, max_data_gap, window_length, parameters, expressions,
+                 log_name, additional_windows=None, history_path=None):
+        super().__init__(daemon_name, None, None, label, query_delay, max_data_gap, window_length, parameters,
+                         log_name, additional_windows=additional_windows, history_path=history_path)
+        self._expressions = expressions
+        self._sources = {}
+
+        # Input measurement timestamps used for the most recent evaluation of each expression
+        self._input_timestamps = [None] * len(expressions)
+
+    def set_sources(self, watchers):
+        """Resolves the watchers referenced by the expressions from a dictionary of {name: PyroWatcher}"""
+        self._sources = {name: watchers[name] for e in self._expressions for name in e.watchers}
+
+    @staticmethod
+    def _buffer_groups(parameters):
+        """Stores each parameter in its own buffer, because their timestamps depend on different inputs"""
+        return [[i] for i in range(len(parameters))]
+
+    def poll(self):
+        """Re-evaluates the expressions whose inputs have changed and ingests the results.
+           Called periodically by a PollScheduler"""
+        latest = {name: watcher.latest_measurement() for name, watcher in self._sources.items()}
+        latest = {name: measurement for name, measurement in latest.items() if measurement is not None}
+        if not latest:
+            return
+
+        ingest_start = time.perf_counter()
+        measurements = []
+        for i, (parameter, expression) in enumerate(zip(self._parameters, self._expressions)):
+            timestamps = tuple(latest[w][0] if w in latest else None for w in expression.watchers)
+            if timestamps == self._input_timestamps[i]:
+                continue
+
+            self._input_timestamps[i] = timestamps
+            value = expression.evaluate({w: latest[w][1] for w in expression.watchers if w in latest})
+            if value is not None:
+                # Expressions are only evaluated when all of their inputs are available
+                measurements.append((min(timestamps), i, {parameter.fields[0]: value}))
+
+        if not measurements:
+            return
+
+        # The history log is searched by time, so is written in time order within each poll.
+        # Values from different polls may be slightly out of order, which only affects which of
+        # the oldest measurements are restored or compacted from the log
+        measurements.sort(key=lambda m: m[0])
+        with self._locked():
+            for timestamp, index, data in measurements:
+                buffer = self._buffers[index].buffer
+                if len(buffer) and timestamp < buffer.timestamp(buffer.end - 1):
+                    # The input dates have gone backwards (e.g. after a clock reset; see PyroWatcher._process),
+                    # so the earlier values of this parameter can't be aggregated with the new one
+                    self._discard_parameter(index)
+
+                self._ingest(timestamp, data)
+                self._append_history(timestamp, data)
+
+            self._latest = measurements[-1][0], measurements[-1][2]
+            self._has_data = True
+            self._publish(time.time())
+
+        self._metrics.ingest_time.observe(time.perf_counter() - ingest_start)
+
+    def _discard_parameter(self, index):
+        """Discards the buffered and rolled up measurements of a parameter. Must be called with _data_lock held"""
+        for windows in self._windows.values():
+            windows[index].clear()
+        for rollup in self._history.rollups[index]:
+            rollup.clear()
+        self._buffers[index].buffer.clear()
@@ -0,0 +1,195 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Classes used for storing the measurements received by a watcher"""
+
+from array import array
+import bisect
+
+
+class MeasurementColumn:
+    """
+    Values of a single measurement field.
+
+    Numbers are stored in a float array, with a flag recording whether all values were
+    integers so that they can be returned with their original type. Any other values
+    (bools, strings, None) switch the column to storing codes that index a table of
+    interned values. Measurements that don't include the field are marked as missing.
+    """
+    def __init__(self):
+        self._values = array('d')
+        self._present = bytearray()
+        self._integral = True
+
+        # Interned value table, used once a non-numeric value has been seen
+        self._interned = None
+        self._codes = None
+
+    def append(self, measurement, field):
+        """Appends the value of field from a measurement dictionary"""
+        if field not in measurement:
+            self._present.append(0)
+            self._values.append(0)
+            return
+
+        value = measurement[field]
+        self._present.append(1)
+        if self._interned is None:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self._values.append(value)
+                if not isinstance(value, int):
+                    self._integral = False
+                return
+
+            self._convert_to_interned()
+
+        # _intern may replace the array, so it must be called before looking up append
+        code = self._intern(value)
+        self._values.append(code)
+
+    def _intern(self, value):
+        # Include the type in the key so that e.g. True and 1 are stored separately
+        key = (type(value), value)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self._interned)
+            self._interned.append(value)
+            if code == 256 and self._values.typecode == 'B':
+                self._values = array('l', self._values)
+        return code
+
+    def _convert_to_interned(self):
+        numbers = self._values
+        self._interned = []
+        self._codes = {}
+        self._values = array('B')
+        for i, value in enumerate(numbers):
+            code = self._intern(int(value) if self._integral else value) if self._present[i] else 0
+            self._values.append(code)
+
+    def get(self, index):
+        """Returns the value stored at an index, or None if the measurement didn't include the field"""
+        if not self._present[index]:
+            return None
+
+        value = self._values[index]
+        if self._interned is not None:
+            return self._interned[value]
+        return int(value) if self._integral else value
+
+    def present(self, index):
+        """Returns True if the measurement at an index included this field"""
+        return bool(self._present[index])
+
+    def discard(self, count):
+        """Removes the oldest count values"""
+        del self._values[:count]
+        del self._present[:count]
+
+    def nbytes(self):
+        """Approximate number of bytes used to store the column"""
+        return self._values.itemsize * len(self._values) + len(self._present)
+
+
+class MeasurementBuffer:
+    """
+    Columnar store of the measurements received by a watcher.
+
+    Only the timestamp (unix epoch seconds) and the configured fields are kept for each
+    measurement. Rows are identified by a sequence number that increases for each appended
+    measurement, and are discarded from the start of the buffer as they leave the time window.
+    Measurements must be appended in time order (repeated timestamps are allowed), so that the start
+    of a time window can be found with a binary search of the timestamp column.
+    """
+    def __init__(self, fields):
+        self._timestamps = array('d')
+        self._columns = {field: MeasurementColumn() for field in fields}
+
+        # Index of the oldest retained row in the arrays, and the sequence number of array index 0.
+        # Discarded rows are only removed from the arrays once they make up half of the storage.
+        self._head = 0
+        self._base = 0
+
+    @property
+    def fields(self):
+        """Names of the stored measurement fields"""
+        return list(self._columns.keys())
+
+    @property
+    def start(self):
+        """Sequence number of the oldest retained measurement"""
+        return self._base + self._head
+
+    @property
+    def end(self):
+        """Sequence number that will be assigned to the next measurement"""
+        return self._base + len(self._timestamps)
+
+    def __len__(self):
+        return len(self._timestamps) - self._head
+
+    def append(self, timestamp, measurement):
+        """Stores the configured fields of a measurement dictionary and returns its sequence number.
+           Raises ValueError if the timestamp is before the newest retained measurement"""
+        if len(self._timestamps) > self._head and timestamp < self._timestamps[-1]:
+            raise ValueError(f'measurement timestamp {timestamp} is before the previous measurement')
+
+        sequence = self.end
+        self._timestamps.append(timestamp)
+        for field, column in self._columns.items():
+            column.append(measurement, field)
+        return sequence
+
+    def find(self, timestamp):
+        """Returns the sequence number of the first measurement at or after the given timestamp"""
+        return self._base + bisect.bisect_left(self._timestamps, timestamp, lo=self._head)
+
+    def timestamp(self, sequence):
+        """Returns the timestamp of a measurement"""
+        return self._timestamps[sequence - self._base]
+
+    def value(self, field, sequence):
+        """Returns the value of a field for a measurement, or None if it was not included"""
+        return self._columns[field].get(sequence - self._base)
+
+    def row(self, sequence):
+        """Reconstructs the measurement dictionary for a sequence number.
+           The date is returned as a unix timestamp"""
+        index = sequence - self._base
+        row = {'date': self._timestamps[index]}
+        for field, column in self._columns.items():
+            if column.present(index):
+                row[field] = column.get(index)
+        return row
+
+    def discard(self, sequence):
+        """Discards all measurements before the given sequence number"""
+        self._head = max(self._head, min(sequence - self._base, len(self._timestamps)))
+        if self._head > 64 and self._head * 2 > len(self._timestamps):
+            del self._timestamps[:self._head]
+            for column in self._columns.values():
+                column.discard(self._head)
+            self._base += self._head
+            self._head = 0
+
+    def clear(self):
+        """Discards all measurements"""
+        self.discard(self.end)
+
+    def nbytes(self):
+        """Approximate number of bytes used to store the measurements"""
+        return self._timestamps.itemsize * len(self._timestamps) + \
+            sum(c.nbytes() for c in self._columns.values())
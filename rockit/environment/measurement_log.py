@@ -0,0 +1,133 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Class used for persisting watcher measurements to disk"""
+
+# pylint: disable=consider-using-with
+
+import json
+import mmap
+import os
+import threading
+
+
+class MeasurementLog:
+    """
+    Append-only log of the measurements received by a watcher.
+
+    Each line contains the unix timestamp of the measurement followed by a json object of
+    the configured measurement fields. Lines are written in time order, so the start of a
+    time range can be found by a binary search of the memory-mapped file. The log is
+    periodically compacted to discard measurements that are older than the retention period.
+    """
+    def __init__(self, path, fields, retention):
+        self._path = path
+        self._fields = fields
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._last_compacted = 0
+
+    def append(self, timestamp, measurement):
+        """Writes the configured fields of a measurement dictionary to the end of the log"""
+        record = {f: measurement[f] for f in self._fields if f in measurement}
+        line = repr(float(timestamp)) + ' ' + json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+            if timestamp - self._last_compacted > self._retention:
+                self._compact(timestamp - self._retention)
+                self._last_compacted = timestamp
+
+    def read(self, start):
+        """Returns a list of (timestamp, measurement) tuples for the measurements at or after start"""
+        with self._lock:
+            with open(self._path, 'rb') as log_file:
+                if os.fstat(log_file.fileno()).st_size == 0:
+                    return []
+
+                with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    offset = self._find(data, start)
+                    records = []
+                    for line in data[offset:].splitlines():
+                        try:
+                            timestamp, record = line.split(b' ', 1)
+                            records.append((float(timestamp), json.loads(record)))
+                        except ValueError:
+                            # Ignore a partially written line from an unclean shutdown
+                            continue
+                    return records
+
+    def close(self):
+        """Closes the log file. No more measurements may be appended"""
+        with self._lock:
+            self._file.close()
+
+    def clear(self):
+        """Discards all measurements from the log"""
+        with self._lock:
+            self._file.truncate(0)
+            self._file.seek(0)
+            self._last_compacted = 0
+
+    def _compact(self, start):
+        """Rewrites the log to discard measurements before start.
+           Must be called with _lock held"""
+        with open(self._path, 'rb') as log_file:
+            if os.fstat(log_file.fileno()).st_size == 0:
+                return
+
+            with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = self._find(data, start)
+                if offset == 0:
+                    return
+
+                temp_path = self._path + '.tmp'
+                with open(temp_path, 'wb') as temp_file:
+                    temp_file.write(data[offset:])
+
+        self._file.close()
+        os.replace(temp_path, self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _find(data, start):
+        """Returns the byte offset of the first line with a timestamp at or after start"""
+        def line_start(offset):
+            # Offset of the first line that begins at or after offset
+            if offset == 0:
+                return 0
+            newline = data.find(b'\n', offset - 1)
+            return len(data) if newline == -1 else newline + 1
+
+        def line_timestamp(offset):
+            try:
+                return float(data[offset:data.find(b' ', offset)])
+            except ValueError:
+                return -1
+
+        low = 0
+        high = len(data)
+        while low < high:
+            middle = (low + high) // 2
+            offset = line_start(middle)
+            if offset < len(data) and line_timestamp(offset) < start:
+                low = middle + 1
+            else:
+                high = middle
+
+        return line_start(low)
@@ -0,0 +1,190 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Classes used for recording internal timing and counter metrics"""
+
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+
+# Histogram bucket upper bounds (seconds), spanning 10us to 10s
+TIMING_BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                  0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets"""
+    def __init__(self, buckets=None):
+        self._lock = threading.Lock()
+        self._bounds = buckets or TIMING_BUCKETS
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        """Records a value"""
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        """Context manager that records the time taken to run its body"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def to_dict(self):
+        """Returns the count, sum, and cumulative bucket counts as a dictionary"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+
+        buckets = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._bounds + ['+Inf'], counts):
+            cumulative += bucket_count
+            buckets.append([bound, cumulative])
+
+        return {'count': count, 'sum': total, 'buckets': buckets}
+
+
+class Counter:
+    """Monotonically increasing count of events"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        """Increments the counter"""
+        with self._lock:
+            self._value += amount
+
+    def to_dict(self):
+        """Returns the current value as a dictionary"""
+        return {'value': self._value}
+
+
+class Gauge:
+    """Value that is sampled from a callback when the metrics are read"""
+    def __init__(self, callback):
+        self._callback = callback
+
+    def to_dict(self):
+        """Returns the current value as a dictionary"""
+        return {'value': self._callback()}
+
+
+class MetricsRegistry:
+    """Collection of named metrics, each of which may have several label sets"""
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # name -> (type, help, {label tuple: metric})
+        self._metrics = {}
+
+    def _get(self, metric_type, name, description, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._metrics.setdefault(name, (metric_type, description, {}))
+            metric = entry[2].get(key)
+            if metric is None:
+                metric = entry[2][key] = factory()
+            return metric
+
+    def histogram(self, name, description, **labels):
+        """Returns the Histogram for a name and set of labels, creating it if needed"""
+        return self._get('histogram', name, description, labels, Histogram)
+
+    def counter(self, name, description, **labels):
+        """Returns the Counter for a name and set of labels, creating it if needed"""
+        return self._get('counter', name, description, labels, Counter)
+
+    def gauge(self, name, description, callback, **labels):
+        """Registers a callback that returns the value of a gauge for a name and set of labels"""
+        return self._get('gauge', name, description, labels, lambda: Gauge(callback))
+
+    def remove(self, **labels):
+        """Removes all metrics that match the given labels"""
+        with self._lock:
+            for _, _, metrics in self._metrics.values():
+                for key in list(metrics):
+                    if all(item in key for item in labels.items()):
+                        del metrics[key]
+
+    def to_dict(self):
+        """Returns a dictionary of {name: {type, help, values: [{labels, ...}]}}"""
+        with self._lock:
+            metrics = {name: (t, d, list(m.items())) for name, (t, d, m) in self._metrics.items()}
+
+        ret = {}
+        for name, (metric_type, description, entries) in metrics.items():
+            values = []
+            for key, metric in entries:
+                value = metric.to_dict()
+                value['labels'] = dict(key)
+                values.append(value)
+            ret[name] = {'type': metric_type, 'help': description, 'values': values}
+        return ret
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        return format_prometheus(self.to_dict())
+
+
+def merge_metrics(metrics):
+    """Combines a list of MetricsRegistry.to_dict() dictionaries (e.g. from several processes)"""
+    ret = {}
+    for metrics_dict in metrics:
+        for name, metric in metrics_dict.items():
+            entry = ret.setdefault(name, {'type': metric['type'], 'help': metric['help'], 'values': []})
+            entry['values'].extend(metric['values'])
+    return ret
+
+
+def format_prometheus(metrics):
+    """Returns a MetricsRegistry.to_dict() dictionary in the Prometheus text exposition format"""
+    def format_labels(labels, extra=None):
+        items = list(labels.items()) + (extra or [])
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+    lines = []
+    for name, metric in metrics.items():
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for value in metric['values']:
+            labels = value['labels']
+            if metric['type'] == 'histogram':
+                for bound, count in value['buckets']:
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {value["value"]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics for the running daemon
+registry = MetricsRegistry()
@@ -0,0 +1,255 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Class used for dispatching periodic watcher queries from a single thread"""
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from .pyro_watcher import poll_batch
+
+
+class PollStatistics:
+    """Timing statistics for the queries made by a single watcher"""
+    def __init__(self):
+        self.count = 0
+        self.overruns = 0
+        self.last_latency = 0
+        self.max_latency = 0
+        self.total_latency = 0
+        self.last_drift = 0
+        self.max_drift = 0
+        self.query_delay = 0
+
+    def update(self, latency, drift, overrun, query_delay):
+        """Records the timing of a completed query"""
+        self.count += 1
+        self.query_delay = query_delay
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        self.last_drift = drift
+        self.max_drift = max(self.max_drift, drift)
+        if overrun:
+            self.overruns += 1
+
+    def to_dict(self):
+        """Returns the statistics as a dictionary that can be serialized by Pyro"""
+        return {
+            'count': self.count,
+            'overruns': self.overruns,
+            'latency_last': self.last_latency,
+            'latency_max': self.max_latency,
+            'latency_mean': self.total_latency / self.count if self.count else 0,
+            'drift_last': self.last_drift,
+            'drift_max': self.max_drift,
+            'query_delay': self.query_delay,
+        }
+
+
+class PollScheduler:
+    """
+    Dispatches the queries for a set of watchers from a single timer thread.
+
+    Pending queries are kept in a heap ordered by their due time, and are run on a
+    bounded pool of worker threads so that the number of concurrent connections is capped
+    and a slow daemon only occupies a single worker while the others continue to be queried.
+    Each watcher is only rescheduled after its previous query has completed.
+
+    Watchers that query the same daemon at the same rate are polled together using a single
+    connection and a batched Pyro call per cycle (see PyroWatcher.batch_key and poll_batch).
+
+    The heap also holds a refresh for each watcher at the time its snapshot expires,
+    so that the published status is kept up to date without Pyro clients taking the watcher locks.
+    """
+    def __init__(self, max_workers, jitter=0.05):
+        self._jitter = jitter
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='poll')
+        self._condition = threading.Condition()
+
+        # (due time, sequence, watchers, refresh) ordered by due time
+        # sequence is a tie-breaker to avoid comparing the watchers.
+        # Poll entries hold a list of watchers that are queried together, refresh entries a single watcher
+        self._queue = []
+        self._sequence = itertools.count()
+        self._statistics = {}
+
+        # Due time of the pending refresh for each watcher.
+        # Refreshes in the queue that don't match this have been superseded and are ignored
+        self._refresh_due = {}
+
+        # Lists of watchers that are polled together, keyed by (batch key, query rate)
+        self._groups = {}
+
+        # The group that each scheduled watcher belongs to, keyed by name
+        self._watcher_groups = {}
+
+    def add(self, watcher):
+        """Schedules a watcher to be queried at its query rate.
+           The first query is made at a random offset within one period to spread out the load"""
+        with self._condition:
+            self._statistics[watcher.daemon_name] = PollStatistics()
+
+            key = watcher.batch_key
+            if key is not None:
+                group = self._groups.get((key, watcher.query_delay))
+                if group is not None:
+                    # Joins the existing group at its next poll
+                    group.append(watcher)
+                    self._watcher_groups[watcher.daemon_name] = group
+                    return
+
+                group = self._groups[(key, watcher.query_delay)] = [watcher]
+            else:
+                group = [watcher]
+            self._watcher_groups[watcher.daemon_name] = group
+
+        self._schedule(group, time.monotonic() + random.uniform(0, watcher.query_delay))
+
+    def remove(self, watcher):
+        """Stops querying a watcher. A query that is already in progress is allowed to complete"""
+        with self._condition:
+            self._statistics.pop(watcher.daemon_name, None)
+            self._refresh_due.pop(watcher, None)
+            group = self._watcher_groups.get(watcher.daemon_name)
+            if group is None or not any(w is watcher for w in group):
+                return
+
+            del self._watcher_groups[watcher.daemon_name]
+            group[:] = [w for w in group if w is not watcher]
+            if not group:
+                # The queued poll for an empty group is dropped when it becomes due
+                for key, candidate in list(self._groups.items()):
+                    if candidate is group:
+                        del self._groups[key]
+
+    def start(self):
+        """Starts dispatching queries"""
+        threading.Thread(target=self.__run_thread, daemon=True).start()
+
+    def statistics(self):
+        """Returns a dictionary of PollStatistics dictionaries keyed by watcher name"""
+        with self._condition:
+            return {name: s.to_dict() for name, s in self._statistics.items()}
+
+    def _schedule(self, watchers, due):
+        with self._condition:
+            heapq.heappush(self._queue, (due, next(self._sequence), watchers, False))
+            self._condition.notify()
+
+    def _schedule_refresh(self, watcher, valid_until):
+        """Schedules a refresh at valid_until (unix timestamp) unless an earlier one is already pending"""
+        if valid_until == math.inf:
+            return
+
+        due = time.monotonic() + valid_until - time.time()
+        with self._condition:
+            # Ignore watchers that have been removed
+            group = self._watcher_groups.get(watcher.daemon_name)
+            if group is None or not any(w is watcher for w in group):
+                return
+
+            pending = self._refresh_due.get(watcher)
+            if pending is not None and pending <= due:
+                return
+
+            self._refresh_due[watcher] = due
+            heapq.heappush(self._queue, (due, next(self._sequence), watcher, True))
+            self._condition.notify()
+
+    def __run_thread(self):
+        """Run loop for dispatching queries when they become due"""
+        while True:
+            with self._condition:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                due = self._queue[0][0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                _, _, watchers, refresh = heapq.heappop(self._queue)
+                if refresh:
+                    if self._refresh_due.get(watchers) != due:
+                        continue
+                    del self._refresh_due[watchers]
+
+            try:
+                if refresh:
+                    self._executor.submit(self._refresh, watchers)
+                else:
+                    self._executor.submit(self._poll, watchers, due)
+            except RuntimeError:
+                # The executor has been shut down because the interpreter is exiting
+                return
+
+    def _poll(self, group, due):
+        """Queries a group of watchers on a worker thread and schedules their next query"""
+        with self._condition:
+            watchers = list(group)
+
+        if not watchers:
+            # All of the watchers in the group have been removed
+            return
+
+        names = ', '.join(w.daemon_name for w in watchers)
+        start = time.monotonic()
+        try:
+            if len(watchers) == 1:
+                watchers[0].poll()
+            else:
+                poll_batch(watchers)
+        except Exception as exception:
+            print(f'{datetime.datetime.utcnow()} ERROR: failed to poll {names}: {exception}')
+
+        end = time.monotonic()
+        query_delay = watchers[0].next_query_delay
+        next_due = due + query_delay * (1 + random.uniform(-self._jitter, self._jitter))
+
+        # Don't try to catch up if the query took longer than the query rate
+        overrun = next_due < end
+        if overrun:
+            print(f'{datetime.datetime.utcnow()} WARNING: query to {names} ' +
+                  f'took {end - start:.1f}s (query rate {query_delay}s)')
+            next_due = end
+
+        with self._condition:
+            for watcher in watchers:
+                statistics = self._statistics.get(watcher.daemon_name)
+                if statistics is not None:
+                    statistics.update(end - start, start - due, overrun, query_delay)
+
+        self._schedule(group, next_due)
+        for watcher in watchers:
+            self._schedule_refresh(watcher, watcher.snapshot().valid_until)
+
+    def _refresh(self, watcher):
+        """Republishes an expired watcher snapshot on a worker thread and schedules the next refresh"""
+        try:
+            valid_until = watcher.refresh()
+        except Exception as exception:
+            print(f'{datetime.datetime.utcnow()} ERROR: failed to refresh {watcher.daemon_name}: {exception}')
+            return
+
+        self._schedule_refresh(watcher, valid_until)
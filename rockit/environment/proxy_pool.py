@@ -0,0 +1,110 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Class used for reusing Pyro connections to the hardware daemons"""
+
+# pylint: disable=protected-access
+
+import threading
+import time
+import Pyro4
+
+
+class ProxyUnavailableError(Exception):
+    """Raised when a connection is not attempted because the daemon is backing off after failures"""
+
+
+class _PooledProxy:
+    """Connection state for a single daemon"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proxy = None
+        self.failures = 0
+        self.retry_time = 0
+        self.circuit_open = False
+
+
+class ProxyPool:
+    """
+    Keeps Pyro proxies open between queries, keyed by daemon.
+
+    A reused proxy is checked by making the call and retrying once on a fresh connection
+    if the daemon had closed the old one. After a communication failure the daemon is not
+    contacted again until an exponentially increasing backoff delay has passed, and after
+    failure_threshold consecutive failures the circuit is opened and the daemon is left alone
+    for circuit_timeout seconds before a single trial connection is made.
+    """
+    def __init__(self, initial_backoff=5, max_backoff=60, failure_threshold=5, circuit_timeout=120):
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._failure_threshold = failure_threshold
+        self._circuit_timeout = circuit_timeout
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _entry(self, daemon):
+        with self._lock:
+            entry = self._entries.get(daemon)
+            if entry is None:
+                entry = self._entries[daemon] = _PooledProxy()
+            return entry
+
+    def call(self, daemon, method, *args):
+        """Calls a method on the given daemon using a pooled proxy.
+           Raises ProxyUnavailableError if the daemon is backing off after previous failures"""
+        entry = self._entry(daemon)
+        with entry.lock:
+            if time.monotonic() < entry.retry_time:
+                state = 'circuit open' if entry.circuit_open else 'backing off'
+                raise ProxyUnavailableError(f'{state} after {entry.failures} failures')
+
+            try:
+                result = self._invoke(entry, daemon, method, args)
+            except Pyro4.errors.CommunicationError:
+                self._release(entry)
+                entry.failures += 1
+                if entry.failures >= self._failure_threshold:
+                    entry.circuit_open = True
+                    delay = self._circuit_timeout
+                else:
+                    delay = min(self._max_backoff, self._initial_backoff * 2 ** (entry.failures - 1))
+                entry.retry_time = time.monotonic() + delay
+                raise
+
+            entry.failures = 0
+            entry.retry_time = 0
+            entry.circuit_open = False
+            return result
+
+    def _invoke(self, entry, daemon, method, args):
+        """Calls a method using the pooled proxy, connecting if there is no open connection"""
+        if entry.proxy is not None:
+            try:
+                return getattr(entry.proxy, method)(*args)
+            except Pyro4.errors.ConnectionClosedError:
+                # The daemon has closed the connection since we last used it
+                # (e.g. because it restarted), so try again with a fresh connection
+                self._release(entry)
+
+        entry.proxy = daemon.connect()
+        return getattr(entry.proxy, method)(*args)
+
+    @staticmethod
+    def _release(entry):
+        """Closes and discards the proxy for a daemon"""
+        if entry.proxy is not None:
+            entry.proxy._pyroRelease()
+            entry.proxy = None
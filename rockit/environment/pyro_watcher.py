@@ -16,91 +16,771 @@
 
 """Class used for aggregating daemon state over time"""
 
-from collections import deque
+# pylint: disable=too-many-arguments
+
+from collections import namedtuple
+from contextlib import contextmanager
 import datetime
 import math
+import os
 import threading
 import time
+import Pyro4
 from rockit.common import log
+from .aggregate_parameter import filter_groups, format_summary_dates
+from .measurement_buffer import MeasurementBuffer
+from .measurement_log import MeasurementLog
+from .metrics import registry
+from .proxy_pool import ProxyUnavailableError
+from .rollup import Rollup, ROLLUP_RESOLUTIONS
+from .timestamps import format_timestamp, parse_timestamp
+
+# Immutable aggregate status published by a PyroWatcher.
+# version increases every time the status changes, and the status remains
+# accurate until valid_until (unix timestamp), when the next measurement expires or goes stale.
+# status uses each parameter's own window length, and windows maps each configured
+# window length to the status with all parameters aggregated over that window.
+# epoch_status and epoch_windows are the same with date_start and date_end as unix timestamps.
+# safety is a tuple of (parameter name, reason) for the parameters in status that are unsafe or have no current data.
+StatusSnapshot = namedtuple('StatusSnapshot', ['version', 'status', 'windows', 'valid_until',
+                                               'epoch_status', 'epoch_windows', 'safety'])
+
+# Measurements dated more than this many seconds after the system clock are discarded, and measurement
+# dates that go backwards by more than this are treated as a reset of the sensor clock
+MAX_CLOCK_SKEW = 60
+
+# Measurement buffer shared by a group of a watcher's parameters, with the set of fields that it stores,
+# the indices of the parameters, and their (parameter, indices) filter groups (see filter_groups)
+BufferGroup = namedtuple('BufferGroup', ['buffer', 'fields', 'indices', 'filter_groups'])
+
+
+class _QueryRate:
+    """
+    Delay between queries to a watched daemon, which varies between min_delay and max_delay if they differ.
+    Queries are made at min_delay while any parameter is within its query_margins of the limits,
+    or is changing fast enough to reach them before the next query. Otherwise the delay is
+    doubled after each query until it reaches max_delay
+    """
+    def __init__(self, query_delay, min_query_delay=None, max_query_delay=None):
+        self.query_delay = query_delay
+        self.min_delay = min_query_delay or query_delay
+        self.max_delay = max_query_delay or query_delay
+        self.next_delay = query_delay
+
+        # (timestamp, value) of the previous measurement of each parameter with query_margins
+        self._previous_values = {}
+
+    @property
+    def adaptive(self):
+        """True if the delay changes with the measured values"""
+        return self.min_delay != self.max_delay
+
+    def update(self, parameters, timestamp, data):
+        """Updates next_delay for a received measurement"""
+        if not self.adaptive:
+            return
+
+        near_limits = False
+        for parameter in parameters:
+            if parameter.query_margins is None or not parameter.accepts(data):
+                continue
+
+            value = data[parameter.fields[0]]
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+
+            previous = self._previous_values.get(parameter.name)
+            self._previous_values[parameter.name] = (timestamp, value)
+
+            # Extrapolate the current trend to the time of the next query
+            projected = value
+            if previous is not None and timestamp > previous[0]:
+                projected += (value - previous[1]) / (timestamp - previous[0]) * self.next_delay
+
+            if parameter.near_limits(value) or parameter.near_limits(projected):
+                near_limits = True
+
+        if near_limits:
+            self.next_delay = self.min_delay
+        else:
+            self.next_delay = min(self.next_delay * 2, self.max_delay)
+
+
+class _WatcherMetrics:
+    """Metrics that are recorded for each watcher"""
+    def __init__(self, daemon_name):
+        self.query_time = registry.histogram('environmentd_query_seconds',
+                                             'Round-trip time of queries to the watched daemon',
+                                             watcher=daemon_name)
+        self.ingest_time = registry.histogram('environmentd_ingest_seconds',
+                                              'Time taken to parse and aggregate a received measurement',
+                                              watcher=daemon_name)
+        self.lock_wait_time = registry.histogram('environmentd_lock_wait_seconds',
+                                                 'Time spent waiting to acquire the watcher data lock',
+                                                 watcher=daemon_name)
+        self.failed_queries = registry.counter('environmentd_query_failures_total',
+                                               'Number of queries that raised an exception',
+                                               watcher=daemon_name)
+        self.stale_samples = registry.counter('environmentd_stale_samples_total',
+                                              'Number of received measurements older than the stale age',
+                                              watcher=daemon_name)
+        self.empty_samples = registry.counter('environmentd_empty_samples_total',
+                                              'Number of queries that returned no data',
+                                              watcher=daemon_name)
+        self.out_of_order_samples = registry.counter('environmentd_out_of_order_samples_total',
+                                                     'Number of received measurements older than the previous one',
+                                                     watcher=daemon_name)
+        self.future_samples = registry.counter('environmentd_future_samples_total',
+                                               'Number of received measurements dated in the future',
+                                               watcher=daemon_name)
+
+        # Time taken to summarise each parameter window, in the order of the watcher parameters
+        self.aggregate_time = []
+
+
+class _MeasurementHistory:
+    """Downsampled rollups of each parameter, and the optional on-disk log of the received measurements"""
+    def __init__(self, path):
+        self._path = path
+        self._log = None
+
+        # Rollups of each parameter, ordered from finest to coarsest resolution
+        self.rollups = []
+
+    def configure(self, daemon_name, previous_parameters, parameters, fields, retention):
+        """Creates the rollups and log for a set of parameters.
+           Rollups are kept for parameters that have the same name and fields as before"""
+        previous_rollups = {(p.name, tuple(p.fields)): r for p, r in zip(previous_parameters, self.rollups)}
+        self.rollups = [previous_rollups.get((p.name, tuple(p.fields))) or
+                        [Rollup(length, retention) for length, retention in ROLLUP_RESOLUTIONS]
+                        for p in parameters]
+
+        self.close()
+        if self._path is not None:
+            self._log = MeasurementLog(os.path.join(self._path, daemon_name + '.log'), fields, retention)
+
+    @property
+    def logged(self):
+        """True if measurements are persisted to disk"""
+        return self._log is not None
+
+    def read(self, start):
+        """Returns a list of (timestamp, measurement) tuples from the log for the measurements at or after start"""
+        return self._log.read(start) if self._log is not None else []
+
+    def append(self, timestamp, data):
+        """Writes a measurement to the log, if enabled"""
+        if self._log is not None:
+            self._log.append(timestamp, data)
+
+    def rewrite(self, records):
+        """Replaces the contents of the log with a list of (timestamp, measurement) tuples"""
+        if self._log is not None:
+            self._log.clear()
+            for timestamp, data in records:
+                self._log.append(timestamp, data)
+
+    def clear(self):
+        """Discards the rollups and logged measurements"""
+        for rollups in self.rollups:
+            for rollup in rollups:
+                rollup.clear()
+        if self._log is not None:
+            self._log.clear()
+
+    def close(self):
+        """Closes the log. No more measurements will be written until the history is reconfigured"""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
 
 
 class PyroWatcher:
     """Watches the state of a Pyro daemon"""
+    # Watchers are queried by the PollScheduler of the process that created them (see ShardedWatcher)
+    remote = False
+
     def __init__(self, daemon_name, daemon, method, label, query_delay, max_data_gap, window_length,
-                 parameters, log_name):
+                 parameters, log_name, proxy_pool=None, additional_windows=None, history_path=None,
+                 min_query_delay=None, max_query_delay=None):
         self.daemon_name = daemon_name
         self._daemon = daemon
         self._method = method
-        self._label = label
-        self._query_delay = query_delay
-        self._max_data_gap = datetime.timedelta(seconds=max_data_gap)
-        self._window_length = datetime.timedelta(seconds=window_length)
-        self._parameters = parameters
+        self._rate = _QueryRate(query_delay, min_query_delay, max_query_delay)
         self._log_name = log_name
+        self._proxy_pool = proxy_pool
         self._last_query_failed = False
+        self._data_lock = threading.Lock()
+        self._parameters = []
+        self._metrics = _WatcherMetrics(daemon_name)
+        self._history = _MeasurementHistory(history_path)
+        self._configure(label, max_data_gap, window_length, parameters, additional_windows)
+
+        self._has_data = False
+
+        # (timestamp, measurement) of the most recently received measurement
+        self._latest = None
+        self._snapshot = StatusSnapshot(0, None, None, -math.inf, None, None, None)
+        self._listeners = []
+
+        registry.gauge('environmentd_buffer_measurements', 'Number of measurements held in the buffer',
+                       lambda: sum(len(g.buffer) for g in self._buffers), watcher=daemon_name)
+        registry.gauge('environmentd_buffer_bytes', 'Approximate memory used by the measurement buffer',
+                       lambda: sum(g.buffer.nbytes() for g in self._buffers), watcher=daemon_name)
+
+    def _configure(self, label, max_data_gap, window_length, parameters, additional_windows):
+        """Creates the buffer, windows and rollups for a set of parameters.
+           Rollups are kept for parameters that have the same name and fields as before"""
+        previous_parameters = self._parameters
+        self._label = label
+        self._max_data_gap = max_data_gap
+        self._window_length = window_length
+        self._parameters = parameters
+
+        # Parameters may override the default window length, and additional window
+        # lengths may be requested. All windows share the same measurement buffer.
+        self._parameter_windows = [p.window_length or window_length for p in parameters]
+        self._window_lengths = sorted(set(self._parameter_windows + [window_length] + (additional_windows or [])))
 
         # Place a hard limit on the number of stored measurements to simplify
-        # cleanup.  Additional filtering is required when iterating the queue.
-        queue_len = window_length * 1.1 / query_delay
-        self._data_lock = threading.Lock()
-        self._data = deque(maxlen=math.ceil(queue_len))
+        # cleanup.  Measurements are also expired from the windows based on their age.
+        self._max_measurements = {w: math.ceil(w * 1.1 / self._rate.min_delay) for w in self._window_lengths}
 
-        threading.Thread(target=self.__run_thread, daemon=True).start()
+        # Measurements are stored in time order, in a buffer for each group of parameters (see _buffer_groups)
+        self._buffers = []
+        self._windows = {w: [None] * len(parameters) for w in self._window_lengths}
+        for indices in self._buffer_groups(parameters):
+            group = [parameters[i] for i in indices]
+            fields = list(dict.fromkeys(f for p in group for f in p.fields))
+            buffer = MeasurementBuffer(fields)
+            for windows in self._windows.values():
+                for i in indices:
+                    windows[i] = parameters[i].create_window(buffer)
 
-    def __run_thread(self):
-        """Run loop for monitoring the hardware daemon"""
-        while True:
-            now = datetime.datetime.utcnow
-            try:
-                # The delay between queries is greater than the comm timeout
-                # so there is no point caching the proxy between loops
-                with self._daemon.connect() as daemon:
-                    data = getattr(daemon, self._method)()
+            groups = [(parameter, [indices[i] for i in group_indices])
+                      for parameter, group_indices in filter_groups(group)]
+            self._buffers.append(BufferGroup(buffer, frozenset(fields), indices, groups))
+
+        fields = list(dict.fromkeys(f for p in parameters for f in p.fields))
+
+        # Measurements are optionally persisted to disk so they can be restored after a restart
+        self._history.configure(self.daemon_name, previous_parameters, parameters, fields, self._window_lengths[-1])
+
+        self._metrics.aggregate_time = [registry.histogram('environmentd_aggregate_seconds',
+                                                           'Time taken to summarise a parameter window',
+                                                           watcher=self.daemon_name, parameter=p.name)
+                                        for p in parameters]
 
-                if data is not None:
-                    # Pyro doesn't deserialize dates, so we manually manage this.
-                    data['date'] = datetime.datetime.strptime(data['date'], '%Y-%m-%dT%H:%M:%SZ')
-                    if now() - data['date'] > self._max_data_gap:
-                        print(f'{now()} WARNING: received stale data from {self.daemon_name}: {data["date"]}')
+    def reconfigure(self, label, max_data_gap, window_length, parameters, additional_windows=None):
+        """
+        Replaces the parameter definitions without discarding the buffered measurements.
+        The windows for the new parameters are rebuilt from the measurements in the buffer,
+        so fields that were not previously used by any parameter start without data
+        """
+        with self._locked():
+            rows = [g.buffer.row(sequence) for g in self._buffers
+                    for sequence in range(g.buffer.start, g.buffer.end)]
+            if len(self._buffers) > 1:
+                rows.sort(key=lambda row: row['date'])
 
-                    with self._data_lock:
-                        self._data.append(data)
+            # Metrics for removed parameters are discarded
+            names = {p.name for p in parameters}
+            for parameter in self._parameters:
+                if parameter.name not in names:
+                    registry.remove(watcher=self.daemon_name, parameter=parameter.name)
 
-                        if self._last_query_failed or len(self._data) == 1:
-                            prefix = 'Restored' if self._last_query_failed else 'Established'
-                            log.info(self._log_name, f'{prefix} contact with {self.daemon_name}')
+            self._configure(label, max_data_gap, window_length, parameters, additional_windows)
+            for row in rows:
+                self._ingest(row.pop('date'), row, rollup=False)
 
-                    self._last_query_failed = False
+            self._publish(time.time())
+
+    def close(self):
+        """Releases the history log and metrics of a watcher that is no longer being monitored"""
+        with self._locked():
+            self._history.close()
+        registry.remove(watcher=self.daemon_name)
+
+    def add_listener(self, callback):
+        """Registers a function that is called (with no arguments) whenever a new status version is published.
+           The callback is run with internal locks held, so must return quickly"""
+        self._listeners.append(callback)
+
+    @property
+    def query_delay(self):
+        """Configured delay between queries to the monitored daemon (seconds)"""
+        return self._rate.query_delay
+
+    @property
+    def parameters(self):
+        """List of the AggregateParameters that are aggregated by this watcher"""
+        return self._parameters
+
+    @property
+    def next_query_delay(self):
+        """Delay before the next query to the monitored daemon (seconds)"""
+        return self._rate.next_delay
+
+    def poll(self):
+        """Queries the monitored daemon and ingests the returned measurement.
+           Called periodically by a PollScheduler"""
+        try:
+            with self._metrics.query_time.time():
+                if self._proxy_pool is not None:
+                    data = self._proxy_pool.call(self._daemon, self._method)
                 else:
-                    print(f'{now()} WARNING: received empty data from {self.daemon_name}')
-                    if not self._last_query_failed:
-                        log.error(self._log_name, f'Lost contact with {self.daemon_name}')
-                    self._last_query_failed = True
-            except Exception as exception:
-                print(f'{now()} ERROR: failed to query from {self.daemon_name}: {exception}')
-                if not self._last_query_failed:
-                    log.error(self._log_name, f'Lost contact with {self.daemon_name}')
-
-                self._last_query_failed = True
-            time.sleep(self._query_delay)
-
-    def status(self):
-        """Queries the aggregate status of the monitored daemon.
-           Returns a dictionary of data"""
+                    # The delay between queries is greater than the comm timeout
+                    # so by default there is no point caching the proxy between loops
+                    with self._daemon.connect() as daemon:
+                        data = getattr(daemon, self._method)()
+
+            self._process(data)
+        except ProxyUnavailableError:
+            # The pool is backing off after an earlier failure that has already been reported
+            self._last_query_failed = True
+        except Exception as exception:
+            self._query_failed(exception)
+
+    @property
+    def batch_key(self):
+        """Watchers with the same (non-None) batch_key and query rate may be queried together by poll_batch"""
+        if self._proxy_pool is not None or self._daemon is None:
+            return None
+
+        # The query rate of adaptive watchers changes independently of any others
+        if self._rate.adaptive:
+            return None
+
+        # Daemon entries are module-level singletons, so watchers of the same daemon share the object
+        return id(self._daemon)
+
+    def _process(self, data):
+        """Ingests a measurement returned by the monitored daemon"""
+        now = datetime.datetime.utcnow
+        if data is not None:
+            ingest_start = time.perf_counter()
+
+            # Pyro doesn't deserialize dates, so we manually manage this.
+            timestamp = parse_timestamp(data['date'])
+
+            # A measurement from the future (e.g. from a sensor with a bad clock) would otherwise be
+            # reported as current until the clock caught up, and hide all the measurements before then
+            if timestamp > time.time() + MAX_CLOCK_SKEW:
+                print(f'{now()} WARNING: discarding future data from {self.daemon_name}: {data["date"]}')
+                self._metrics.future_samples.inc()
+                return
+
+            # The windows require measurements in time order, so a date that goes back a short way
+            # is discarded. Larger steps back are a reset of the sensor clock, so the earlier measurements
+            # are discarded instead of the new ones. Repeated dates are kept
+            latest = self._latest
+            clock_reset = latest is not None and timestamp < latest[0] - MAX_CLOCK_SKEW
+            if latest is not None and not clock_reset and timestamp < latest[0]:
+                print(f'{now()} WARNING: discarding out of order data from {self.daemon_name}: {data["date"]}')
+                self._metrics.out_of_order_samples.inc()
+                return
 
-        # Filter data for the measurements in our desired time window
-        window_start = datetime.datetime.utcnow() - self._window_length
-        stale_threshold = datetime.datetime.utcnow() - self._max_data_gap
+            if time.time() - timestamp > self._max_data_gap:
+                print(f'{now()} WARNING: received stale data from {self.daemon_name}: {data["date"]}')
+                self._metrics.stale_samples.inc()
 
+            with self._locked():
+                if clock_reset:
+                    print(f'{now()} WARNING: clock reset detected for {self.daemon_name} ' +
+                          f'({data["date"]} is before {format_timestamp(latest[0])}); discarding earlier data')
+                    self._discard_measurements()
+
+                self._ingest(timestamp, data)
+                self._latest = (timestamp, data)
+
+                if self._last_query_failed or not self._has_data:
+                    prefix = 'Restored' if self._last_query_failed else 'Established'
+                    log.info(self._log_name, f'{prefix} contact with {self.daemon_name}')
+                self._has_data = True
+                self._publish(time.time())
+                self._append_history(timestamp, data)
+
+            self._metrics.ingest_time.observe(time.perf_counter() - ingest_start)
+            self._rate.update(self._parameters, timestamp, data)
+
+            self._last_query_failed = False
+        else:
+            print(f'{now()} WARNING: received empty data from {self.daemon_name}')
+            self._metrics.empty_samples.inc()
+            if not self._last_query_failed:
+                log.error(self._log_name, f'Lost contact with {self.daemon_name}')
+            self._last_query_failed = True
+
+    def _append_history(self, timestamp, data):
+        """Writes a measurement to the on-disk history. Must be called with _data_lock held,
+           so that a concurrent clear_history can't discard the log before it is written"""
+        try:
+            self._history.append(timestamp, data)
+        except Exception as exception:
+            print(f'{datetime.datetime.utcnow()} ERROR: failed to write history for {self.daemon_name}: ' +
+                  f'{exception}')
+
+    def _query_failed(self, exception):
+        """Reports an exception raised while querying or ingesting from the monitored daemon"""
+        print(f'{datetime.datetime.utcnow()} ERROR: failed to query from {self.daemon_name}: {exception}')
+        self._metrics.failed_queries.inc()
+        if not self._last_query_failed:
+            log.error(self._log_name, f'Lost contact with {self.daemon_name}')
+
+        self._last_query_failed = True
+
+    @contextmanager
+    def _locked(self):
+        """Context manager that holds _data_lock and records the time spent waiting for it.
+           The snapshot is republished before the lock is released if it expired while the lock was held,
+           because snapshot() can't republish it while another thread holds the lock"""
+        start = time.perf_counter()
         with self._data_lock:
-            measurements = [m for m in self._data if m['date'] >= window_start]
+            self._metrics.lock_wait_time.observe(time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                now = time.time()
+                if now > self._snapshot.valid_until:
+                    self._publish(now)
+
+    @contextmanager
+    def _locked_if_free(self):
+        """Context manager that holds _data_lock only if it can be acquired without blocking.
+           Yields True if the lock is held"""
+        acquired = self._data_lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._data_lock.release()
+
+    def load_history(self):
+        """Restores the measurements within the longest window from the on-disk history.
+           Returns the number of measurements that were restored"""
+        if not self._history.logged:
+            return 0
+
+        now = time.time()
+        records = self._history.read(now - self._window_lengths[-1])
+        with self._locked():
+            # Rewrite the log without any measurements from the future (see _process), which would
+            # otherwise be restored as the latest measurement and hide new measurements until they are reached
+            valid = [r for r in records if r[0] <= now + MAX_CLOCK_SKEW]
+            if len(valid) != len(records):
+                print(f'{datetime.datetime.utcnow()} WARNING: discarding {len(records) - len(valid)} future ' +
+                      f'measurements from the history of {self.daemon_name}')
+                records = valid
+                self._history.rewrite(records)
+
+            for timestamp, data in records:
+                self._ingest(timestamp, data)
+            if records:
+                self._latest = records[-1]
+            self._publish(now)
+
+        return len(records)
+
+    @staticmethod
+    def _buffer_groups(parameters):
+        """Returns a list of the parameter indices that share each measurement buffer.
+           Measurements must be ingested in time order within each buffer, so parameters that
+           are measured together share a single buffer"""
+        return [list(range(len(parameters)))]
+
+    def _ingest(self, timestamp, data, rollup=True):
+        """Adds a measurement to the buffers and the parameter windows, and the rollups if rollup is True.
+           Buffers that don't use any of the measurement fields are skipped. Must be called with _data_lock held"""
+        for buffer, fields, _, groups in self._buffers:
+            if fields.isdisjoint(data):
+                continue
+
+            sequence = buffer.append(timestamp, data)
+            for parameter, indices in groups:
+                if not parameter.accepts(data):
+                    continue
+
+                for windows in self._windows.values():
+                    for i in indices:
+                        windows[i].append(sequence)
+
+                if not rollup:
+                    continue
+
+                value = buffer.value(parameter.fields[0], sequence)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    for i in indices:
+                        for parameter_rollup in self._history.rollups[i]:
+                            parameter_rollup.add(timestamp, value)
+
+    def _expire(self, now):
+        """Discards measurements that are outside the time windows or exceed the buffer length.
+           Must be called with _data_lock held"""
+        for buffer, _, indices, _ in self._buffers:
+            buffer_start = buffer.end
+            for length, windows in self._windows.items():
+                start = max(buffer.find(now - length), buffer.end - self._max_measurements[length])
+                for i in indices:
+                    windows[i].expire(start)
+                buffer_start = min(buffer_start, start)
+
+            buffer.discard(buffer_start)
+
+    def _publish(self, now):
+        """Recalculates the aggregate status and updates the published snapshot.
+           Must be called with _data_lock held"""
+        self._expire(now)
+        stale_threshold = now - self._max_data_gap
+
+        valid_until = math.inf
+        summaries = {}
+        for length, windows in self._windows.items():
+            summaries[length] = []
+            for parameter, window, timer in zip(self._parameters, windows, self._metrics.aggregate_time):
+                aggregate_start = time.perf_counter()
+                summary = parameter.summarise(window, stale_threshold, epoch_dates=True)
+                timer.observe(time.perf_counter() - aggregate_start)
+                summaries[length].append(summary)
+                if window.count:
+                    valid_until = min(valid_until, window.date_start + length)
+                    if summary['current']:
+                        valid_until = min(valid_until, window.date_end + self._max_data_gap)
+
+        def build_status(summaries):
+            # The default status reuses the summaries from each parameter's own window
+            status = {
+                'label': self._label,
+                'parameters': {p.name: summaries[w][i] for i, (p, w) in
+                               enumerate(zip(self._parameters, self._parameter_windows))}
+            }
+
+            windows = {}
+            for length, window_summaries in summaries.items():
+                windows[length] = {
+                    'label': self._label,
+                    'parameters': {p.name: s for p, s in zip(self._parameters, window_summaries)}
+                }
+            return status, windows
+
+        epoch_status, epoch_windows = build_status(summaries)
+        version = self._snapshot.version
+        changed = epoch_windows != self._snapshot.epoch_windows
+        if changed:
+            version += 1
+            status, windows = build_status({length: [format_summary_dates(s) for s in window_summaries]
+                                            for length, window_summaries in summaries.items()})
+
+            # Only parameters with limits or valid values can make the site unsafe,
+            # and these are treated as unsafe when there is no current data
+            safety = tuple((p.name, 'unsafe' if s['unsafe'] else 'no data')
+                           for p, s in zip(self._parameters, epoch_status['parameters'].values())
+                           if p.affects_safety and (s['unsafe'] or not s['current']))
+        else:
+            status = self._snapshot.status
+            windows = self._snapshot.windows
+            safety = self._snapshot.safety
+
+        self._snapshot = StatusSnapshot(version, status, windows, valid_until, epoch_status, epoch_windows, safety)
+
+        if changed:
+            for callback in self._listeners:
+                callback()
 
+    def refresh(self):
+        """Republishes the snapshot if a measurement has expired or gone stale since it was published.
+           Returns the time (unix timestamp) when the snapshot next needs to be refreshed"""
+        with self._locked():
+            now = time.time()
+            if now > self._snapshot.valid_until:
+                self._publish(now)
+            return self._snapshot.valid_until
+
+    def snapshot(self):
+        """Returns the latest StatusSnapshot for the monitored daemon without blocking.
+           Snapshots are normally refreshed by the PollScheduler when they expire, but an expired
+           snapshot is republished here if no other thread holds the data lock. Otherwise the expired
+           snapshot is returned, and is republished by the other thread when it releases the lock (see _locked)"""
+        snapshot = self._snapshot
+        if time.time() > snapshot.valid_until:
+            with self._locked_if_free() as acquired:
+                if acquired:
+                    now = time.time()
+                    if now > self._snapshot.valid_until:
+                        self._publish(now)
+                    snapshot = self._snapshot
+
+        return snapshot
+
+    def replay(self, timestamp, data):
+        """Ingests a recorded measurement without publishing a snapshot.
+           Measurements must be replayed in time order (see evaluate)"""
+        with self._data_lock:
+            self._ingest(timestamp, data, rollup=False)
+            self._latest = (timestamp, data)
+
+    def evaluate(self, now):
+        """
+        Evaluates the safety of each parameter over its own window length at a simulated time (unix timestamp)
+        without publishing a snapshot. Used with replay() to evaluate a config against recorded measurements.
+        Returns a tuple of ({parameter name: (unsafe, warning, current)}, time when the flags may next change
+        without new data). Parameters without any measurements are reported as (False, False, False)
+        """
+        with self._data_lock:
+            self._expire(now)
+            stale_threshold = now - self._max_data_gap
+
+            valid_until = math.inf
+            flags = {}
+            for index, (parameter, length) in enumerate(zip(self._parameters, self._parameter_windows)):
+                window = self._windows[length][index]
+                if not window.count:
+                    flags[parameter.name] = (False, False, False)
+                    continue
+
+                date_end = window.date_end
+                current = date_end >= stale_threshold
+                flags[parameter.name] = parameter.limit_flags(window, current) + (current,)
+
+                valid_until = min(valid_until, window.next_change(length))
+                if current:
+                    valid_until = min(valid_until, date_end + self._max_data_gap)
+
+            return flags, valid_until
+
+    def latest_measurement(self):
+        """Returns a (unix timestamp, measurement dictionary) tuple for the most recently
+           received measurement, or None if there is no data. The dictionary must not be modified"""
+        return self._latest
+
+    @property
+    def version(self):
+        """Version number of the latest status snapshot"""
+        return self.snapshot().version
+
+    def schema(self):
+        """Returns the static metadata for the watcher and its parameters (see AggregateParameter.schema)"""
         return {
+            'name': self.daemon_name,
             'label': self._label,
-            'parameters': {p.name: p.aggregate(measurements, stale_threshold) for p in self._parameters}
+            'parameters': [p.schema() for p in self._parameters]
         }
 
+    @property
+    def window_lengths(self):
+        """Sorted list of the window lengths that can be passed to status()"""
+        return self._window_lengths
+
+    def status(self, window=None, epoch_dates=False):
+        """Queries the aggregate status of the monitored daemon.
+           If window is given, all parameters are aggregated over that window length,
+           which must be one of window_lengths. Otherwise each parameter uses its own window.
+           If epoch_dates is True the parameter dates are given as unix timestamps instead of strings.
+           Returns a dictionary of data that must not be modified"""
+        snapshot = self.snapshot()
+        if window is None:
+            return snapshot.epoch_status if epoch_dates else snapshot.status
+
+        windows = snapshot.epoch_windows if epoch_dates else snapshot.windows
+        if window not in windows:
+            raise ValueError(f'window length {window} is not configured for {self.daemon_name}')
+        return windows[window]
+
+    def history(self, parameter, start, end, resolution):
+        """
+        Queries the history of a parameter between two unix timestamps.
+        A resolution of 0 returns the raw measurements that are still within the longest window,
+        otherwise the finest rollup with a bucket length that is at least resolution (seconds)
+        and retains data back to start is used. Buckets are merged if resolution is longer.
+        Returns a dictionary with the resolution that was used and a list of
+        [timestamp, min, max, mean, count] values
+        """
+        names = [p.name for p in self._parameters]
+        if parameter not in names:
+            raise ValueError(f'unknown parameter {parameter} for {self.daemon_name}')
+        index = names.index(parameter)
+
+        with self._locked():
+            if resolution <= 0:
+                window = self._windows[self._window_lengths[-1]][index]
+                return {
+                    'resolution': 0,
+                    'data': [[t, v, v, v, 1] for t, v in window.measurements() if start <= t <= end]
+                }
+
+            rollups = self._history.rollups[index]
+            rollup = rollups[-1]
+            for candidate in rollups:
+                oldest = candidate.oldest
+                if candidate.bucket_length >= resolution and (oldest is None or oldest <= start):
+                    rollup = candidate
+                    break
+
+            return {
+                'resolution': max(resolution, rollup.bucket_length),
+                'data': rollup.query(start, end, resolution)
+            }
+
+    def _discard_measurements(self):
+        """Discards the buffered, rolled up and logged measurements. Must be called with _data_lock held"""
+        for windows in self._windows.values():
+            for window in windows:
+                window.clear()
+        for group in self._buffers:
+            group.buffer.clear()
+        self._history.clear()
+        self._latest = None
+
     def clear_history(self):
         """Clear the cached measurements"""
-        with self._data_lock:
-            self._data.clear()
+        with self._locked():
+            self._discard_measurements()
+            self._has_data = False
+            self._publish(time.time())
+
+
+def poll_batch(watchers):
+    """
+    Queries several watchers that share a batch_key over a single connection, using a
+    Pyro batch proxy so that all of their method calls are made in one round-trip.
+    Called periodically by a PollScheduler in place of the individual poll() calls
+    """
+    # pylint: disable=protected-access
+    results = []
+    start = time.perf_counter()
+    connection_error = error = None
+    try:
+        with watchers[0]._daemon.connect() as daemon:
+            batch = Pyro4.batch(daemon)
+            for watcher in watchers:
+                getattr(batch, watcher._method)()
+
+            for data in batch():
+                results.append(data)
+    except Pyro4.errors.CommunicationError as exception:
+        connection_error = exception
+    except Exception as exception:
+        error = exception
+
+    elapsed = time.perf_counter() - start
+    for watcher, data in zip(watchers, results):
+        watcher._metrics.query_time.observe(elapsed)
+        try:
+            watcher._process(data)
+        except Exception as exception:
+            watcher._query_failed(exception)
+
+    # Errors raised after all of the results were received (e.g. while closing the connection) are ignored
+    if len(results) == len(watchers):
+        return
+
+    if connection_error is not None:
+        # The daemon can't be reached, so querying the remaining watchers individually
+        # would only wait for the same error once for each watcher
+        for watcher in watchers[len(results):]:
+            watcher._query_failed(connection_error)
+    elif error is not None:
+        # Pyro stops executing a batch at the first call that raises, so the watcher for
+        # that call reports the error and any calls that were not made are retried individually
+        watchers[len(results)]._query_failed(error)
+        for watcher in watchers[len(results) + 1:]:
+            watcher.poll()
@@ -0,0 +1,118 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Class used for maintaining downsampled parameter history"""
+
+from array import array
+import bisect
+import math
+
+# (bucket length, retention) in seconds for the rollups maintained for each numeric parameter
+ROLLUP_RESOLUTIONS = [
+    (60, 86400),
+    (600, 7 * 86400)
+]
+
+
+class Rollup:
+    """
+    Fixed-length time buckets holding the min, max, sum and count of a parameter.
+
+    Buckets are updated incrementally as measurements arrive and are discarded once they
+    are older than the retention period, so the memory used is bounded by retention / bucket_length.
+    """
+    def __init__(self, bucket_length, retention):
+        self.bucket_length = bucket_length
+        self.retention = retention
+        self._starts = array('d')
+        self._min = array('d')
+        self._max = array('d')
+        self._sum = array('d')
+        self._count = array('l')
+
+        # Index of the oldest retained bucket; expired buckets are removed in bulk
+        self._head = 0
+
+    def add(self, timestamp, value):
+        """Adds a measurement to its bucket"""
+        start = math.floor(timestamp / self.bucket_length) * self.bucket_length
+        if not self._starts or start > self._starts[-1]:
+            self._starts.append(start)
+            self._min.append(value)
+            self._max.append(value)
+            self._sum.append(value)
+            self._count.append(1)
+            self._expire(start)
+            return
+
+        # Measurements normally arrive in time order, but may update an earlier bucket
+        index = bisect.bisect_left(self._starts, start, lo=self._head)
+        if index == len(self._starts) or self._starts[index] != start:
+            # Out of order measurements that don't have an existing bucket are dropped
+            return
+
+        self._min[index] = min(self._min[index], value)
+        self._max[index] = max(self._max[index], value)
+        self._sum[index] += value
+        self._count[index] += 1
+
+    def _expire(self, latest):
+        self._head = bisect.bisect_left(self._starts, latest - self.retention, lo=self._head)
+        if self._head > 64 and self._head * 2 > len(self._starts):
+            for column in [self._starts, self._min, self._max, self._sum, self._count]:
+                del column[:self._head]
+            self._head = 0
+
+    def clear(self):
+        """Discards all buckets"""
+        for column in [self._starts, self._min, self._max, self._sum, self._count]:
+            del column[:]
+        self._head = 0
+
+    @property
+    def oldest(self):
+        """Start time of the oldest retained bucket, or None if there are no buckets"""
+        return self._starts[self._head] if self._head < len(self._starts) else None
+
+    def query(self, start, end, resolution=None):
+        """
+        Returns a list of [bucket start, min, max, mean, count] for the buckets between start and end.
+        If resolution is larger than the bucket length then buckets are merged into bins of that length.
+        """
+        first = bisect.bisect_left(self._starts, math.floor(start / self.bucket_length) * self.bucket_length,
+                                   lo=self._head)
+        last = bisect.bisect_right(self._starts, end, lo=first)
+
+        if resolution is None or resolution <= self.bucket_length:
+            return [[self._starts[i], self._min[i], self._max[i], self._sum[i] / self._count[i], self._count[i]]
+                    for i in range(first, last)]
+
+        ret = []
+        for i in range(first, last):
+            bin_start = math.floor(self._starts[i] / resolution) * resolution
+            if ret and ret[-1][0] == bin_start:
+                merged = ret[-1]
+                merged[1] = min(merged[1], self._min[i])
+                merged[2] = max(merged[2], self._max[i])
+                merged[3] += self._sum[i]
+                merged[4] += self._count[i]
+            else:
+                ret.append([bin_start, self._min[i], self._max[i], self._sum[i], self._count[i]])
+
+        for merged in ret:
+            merged[3] /= merged[4]
+
+        return ret
@@ -0,0 +1,78 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Functions used for converting between unix timestamps and the ISO date strings used by the daemons"""
+
+import calendar
+import datetime
+import functools
+import time
+
+# Date format used by the hardware daemons and in the status dictionaries
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Date reported by status() for parameters without any measurements
+NO_DATA_DATE = datetime.datetime.min.strftime(DATE_FORMAT)
+
+
+@functools.lru_cache(maxsize=64)
+def _day_timestamp(day):
+    """Returns the unix timestamp of midnight at the start of a YYYY-MM-DD date string"""
+    return calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+
+
+@functools.lru_cache(maxsize=64)
+def _day_string(day):
+    """Returns the YYYY-MM-DD date string for a number of days since the unix epoch"""
+    return time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+
+
+def parse_timestamp(date):
+    """
+    Converts a YYYY-MM-DDTHH:MM:SSZ date string to an integer unix timestamp.
+    Only the time of day is parsed for each call; the date is cached because consecutive
+    measurements almost always share it. Raises ValueError for strings in any other format
+    """
+    if len(date) != 20 or date[10] != 'T' or date[13] != ':' or date[16] != ':' or date[19] != 'Z':
+        raise ValueError(f'time data {date!r} does not match format {DATE_FORMAT!r}')
+
+    # int() would also accept signs and whitespace, so check that each field is two digits
+    fields = date[11:13] + date[14:16] + date[17:19]
+    if not fields.isascii() or not fields.isdigit():
+        raise ValueError(f'time data {date!r} does not match format {DATE_FORMAT!r}')
+
+    hours = int(date[11:13])
+    minutes = int(date[14:16])
+    seconds = int(date[17:19])
+    if not 0 <= hours <= 23 or not 0 <= minutes <= 59 or not 0 <= seconds <= 61:
+        raise ValueError(f'time data {date!r} does not match format {DATE_FORMAT!r}')
+
+    return _day_timestamp(date[:10]) + hours * 3600 + minutes * 60 + seconds
+
+
+def format_timestamp(timestamp):
+    """Converts a unix timestamp to a YYYY-MM-DDTHH:MM:SSZ date string, truncating to whole seconds"""
+    return _format_seconds(int(timestamp // 1))
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_seconds(timestamp):
+    """Formats an integer unix timestamp. The start and end dates of each window
+       change slowly compared to the publish rate, so most calls are cache hits"""
+    day, seconds = divmod(timestamp, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{_day_string(day)}T{hours:02d}:{minutes:02d}:{seconds:02d}Z'
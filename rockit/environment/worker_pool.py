@@ -0,0 +1,531 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Classes used for running the watchers in a pool of worker processes"""
+
+# pylint: disable=too-many-arguments
+
+import atexit
+import datetime
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import pickle
+import queue
+import struct
+import threading
+import time
+from rockit.common import daemons, log
+from .metrics import registry
+from .poll_scheduler import PollScheduler
+from .proxy_pool import ProxyPool
+from .pyro_watcher import PyroWatcher, StatusSnapshot
+
+# Size of the shared memory segment that each watcher publishes its status to (bytes).
+# Pages are only allocated when they are written, so this only limits the size of a snapshot
+SLOT_SIZE = 4 * 1024 * 1024
+
+# Sequence number and payload length stored at the start of each segment
+SLOT_HEADER = struct.Struct('<QQ')
+
+# Time allowed for a worker to republish an expired snapshot before the front-end
+# reports the parameters of the watcher as having no current data (seconds)
+WORKER_REFRESH_GRACE = 5
+
+# Interval between checks that the worker processes are still running (seconds)
+WORKER_CHECK_INTERVAL = 1
+
+# Time that a reader waits for a write in progress to finish before returning the previously read value (seconds).
+# Writes only copy the payload, so this is only reached if the writer has stopped part-way through a write
+SLOT_READ_TIMEOUT = 0.5
+
+
+class SnapshotSlot:
+    """
+    Shared memory segment holding the latest pickled (StatusSnapshot, latest measurement) of a watcher.
+
+    Each slot has a single writer (the worker process that runs the watcher) and uses a sequence lock:
+    the sequence number is odd while a write is in progress, so readers retry if they see an odd number
+    or if it has changed by the time they have copied the payload. Readers keep the decoded value, so
+    reading an unchanged slot only costs a header read.
+
+    A reader gives up on a write that doesn't finish within SLOT_READ_TIMEOUT (e.g. because the writer
+    was killed during the write) and returns the previously read value until the sequence number changes.
+    """
+    def __init__(self, name=None):
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=SLOT_SIZE)
+            SLOT_HEADER.pack_into(self._memory.buf, 0, 0, 0)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+
+        self._owner = name is None
+        self._sequence = 0
+        self._value = None
+
+        # Odd sequence number of a write that the reader stopped waiting for
+        self._abandoned = None
+
+    @property
+    def name(self):
+        """Name used to attach to the segment from another process"""
+        return self._memory.name
+
+    def write(self, value):
+        """Publishes a value to the slot. Must only be called from a single thread"""
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > SLOT_SIZE - SLOT_HEADER.size:
+            raise ValueError(f'snapshot size {len(payload)} exceeds the shared memory slot size')
+
+        buf = self._memory.buf
+        sequence, length = SLOT_HEADER.unpack_from(buf, 0)
+        SLOT_HEADER.pack_into(buf, 0, sequence + 1, length)
+        buf[SLOT_HEADER.size:SLOT_HEADER.size + len(payload)] = payload
+        SLOT_HEADER.pack_into(buf, 0, sequence + 2, len(payload))
+
+    @property
+    def value(self):
+        """The last value that was read from the slot, without checking for a newer one"""
+        return self._value
+
+    def read(self):
+        """Returns the latest value written to the slot, or None if nothing has been written.
+           The last value that was read is returned after the slot has been closed,
+           or if a write doesn't finish within SLOT_READ_TIMEOUT"""
+        if self._memory is None:
+            return self._value
+
+        buf = self._memory.buf
+        deadline = None
+        while True:
+            sequence, length = SLOT_HEADER.unpack_from(buf, 0)
+            if sequence in (self._sequence, self._abandoned):
+                return self._value
+
+            if not sequence % 2:
+                payload = bytes(buf[SLOT_HEADER.size:SLOT_HEADER.size + length])
+                if SLOT_HEADER.unpack_from(buf, 0)[0] == sequence:
+                    self._value = pickle.loads(payload)
+                    self._sequence = sequence
+                    return self._value
+
+            if deadline is None:
+                deadline = time.monotonic() + SLOT_READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                if sequence % 2:
+                    self._abandoned = sequence
+                return self._value
+
+            time.sleep(0)
+
+    def close(self):
+        """Detaches from the segment, and removes it if it was created by this process"""
+        if self._memory is None:
+            return
+
+        self.read()
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+        self._memory = None
+
+
+class _WorkerProcess:
+    """Front-end handle for a worker process"""
+    def __init__(self, context, index, events, max_concurrent_queries, persistent_connections):
+        self._lock = threading.Lock()
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_run_worker, name=f'environmentd-worker-{index}',
+                                        args=(child, events, max_concurrent_queries, persistent_connections),
+                                        daemon=True)
+        self._process.start()
+        child.close()
+
+        # Names of the watchers that are run by this worker
+        self.watchers = set()
+
+        # Cleared by the WorkerPool when it notices that the process has exited
+        self.alive = True
+
+    @property
+    def name(self):
+        """Name of the worker process"""
+        return self._process.name
+
+    @property
+    def exitcode(self):
+        """Exit code of the worker process, or None if it is still running"""
+        return self._process.exitcode
+
+    def call(self, command, *args):
+        """Runs a command in the worker process and returns the result"""
+        with self._lock:
+            try:
+                self._connection.send((command, args))
+                success, result = self._connection.recv()
+            except (EOFError, OSError) as exception:
+                raise RuntimeError(f'{self._process.name} is not running') from exception
+
+        if not success:
+            raise RuntimeError(result)
+        return result
+
+
+class WorkerPool:
+    """
+    Runs PyroWatchers in a pool of worker processes so that ingest and aggregation are spread across cores.
+
+    Each worker process queries its watchers using its own PollScheduler and publishes their status
+    snapshots to shared memory, where they are read by ShardedWatchers in the front-end process
+    without any round-trips to the workers. Commands that modify the watchers or return their history
+    are sent to the workers over a pipe. Watchers are assigned to the worker that runs the fewest watchers.
+
+    Workers that exit are not restarted: their watchers report no current data (see ShardedWatcher.snapshot)
+    until environmentd is restarted, so that a crash makes the site unsafe rather than freezing its status.
+    """
+    def __init__(self, processes, max_concurrent_queries, persistent_connections, log_name):
+        context = multiprocessing.get_context('spawn')
+        self._log_name = log_name
+
+        # Names of watchers that have published new snapshots
+        self._events = context.Queue()
+        self._watchers = {}
+
+        queries_per_worker = math.ceil(max_concurrent_queries / processes)
+        self._workers = [_WorkerProcess(context, i, self._events, queries_per_worker, persistent_connections)
+                         for i in range(processes)]
+
+        threading.Thread(target=self.__dispatch_events, daemon=True).start()
+
+        # Shared memory segments persist after the process exits unless they are explicitly removed
+        atexit.register(self._release)
+
+    def _release(self):
+        """Removes the shared memory segments of all watchers"""
+        for watcher in list(self._watchers.values()):
+            watcher.release()
+
+    def create_watcher(self, daemon_name, daemon, method, label, query_delay, max_data_gap, window_length,
+                       parameters, log_name, additional_windows=None, history_path=None,
+                       min_query_delay=None, max_query_delay=None):
+        """Starts a PyroWatcher in a worker process and returns the ShardedWatcher that reads its status.
+           daemon is the name of the daemon in rockit.common.daemons. Measurements are restored from the
+           on-disk history if history_path is given"""
+        workers = [w for w in self._workers if w.alive]
+        if not workers:
+            raise RuntimeError('no worker processes are running')
+
+        worker = min(workers, key=lambda w: len(w.watchers))
+        watcher = ShardedWatcher(daemon_name, worker, label, window_length, parameters, additional_windows,
+                                 self._watchers)
+        try:
+            worker.call('add', watcher.slot_name, daemon_name, daemon, method, label, query_delay, max_data_gap,
+                        window_length, parameters, log_name, additional_windows, history_path,
+                        min_query_delay, max_query_delay)
+        except Exception:
+            watcher.close()
+            raise
+
+        return watcher
+
+    def metrics(self):
+        """Returns the metrics dictionaries of each running worker process"""
+        return [worker.call('metrics') for worker in self._workers if worker.alive]
+
+    def poll_statistics(self):
+        """Returns the combined PollScheduler statistics dictionary of the running worker processes"""
+        ret = {}
+        for worker in self._workers:
+            if worker.alive:
+                ret.update(worker.call('poll_statistics'))
+        return ret
+
+    def __dispatch_events(self):
+        """Calls the listeners of watchers that have published a new snapshot, and checks that
+           the workers are still running"""
+        next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+        while True:
+            try:
+                watcher = self._watchers.get(self._events.get(timeout=WORKER_CHECK_INTERVAL))
+            except queue.Empty:
+                watcher = None
+
+            if watcher is not None:
+                watcher.notify_listeners()
+
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+
+    def _check_workers(self):
+        """Reports workers that have exited, and notifies the listeners of their watchers
+           so that waiting clients see that the watchers no longer have data"""
+        for worker in self._workers:
+            if not worker.alive or worker.exitcode is None:
+                continue
+
+            worker.alive = False
+            message = f'{worker.name} exited with code {worker.exitcode}; ' + \
+                f'no data will be reported for {", ".join(sorted(worker.watchers))}'
+            print(f'{datetime.datetime.utcnow()} ERROR: {message}')
+            log.error(self._log_name, message)
+
+            for name in list(worker.watchers):
+                watcher = self._watchers.get(name)
+                if watcher is not None:
+                    watcher.notify_listeners()
+
+
+def _no_data_status(status):
+    """Returns a copy of a watcher status dictionary with every parameter marked as not current"""
+    if status is None:
+        return None
+
+    return {
+        'label': status['label'],
+        'parameters': {name: dict(summary, current=False) for name, summary in status['parameters'].items()}
+    }
+
+
+class ShardedWatcher:
+    """
+    Front-end proxy for a PyroWatcher that runs in a worker process (see WorkerPool).
+    Implements the methods of PyroWatcher that are used by the daemon, reading the status
+    from shared memory and forwarding the other methods to the worker.
+
+    The snapshot versions are doubled, so that the odd version in between can be used for the
+    no data snapshot that is reported if the worker stops publishing (see snapshot)
+    """
+    # Queries are scheduled by the worker process
+    remote = True
+
+    def __init__(self, daemon_name, worker, label, window_length, parameters, additional_windows, registered):
+        self.daemon_name = daemon_name
+        self._worker = worker
+        self._registered = registered
+        self._listeners = []
+        self._slot = SnapshotSlot()
+
+        # (snapshot read from the slot, snapshot returned to the daemon, no data snapshot or None)
+        self._snapshots = (None, None, None)
+        self._set_parameters(label, window_length, parameters, additional_windows)
+
+        worker.watchers.add(daemon_name)
+        registered[daemon_name] = self
+
+    def _set_parameters(self, label, window_length, parameters, additional_windows):
+        self._label = label
+        self._parameters = parameters
+        parameter_windows = [p.window_length or window_length for p in parameters]
+        self._window_lengths = sorted(set(parameter_windows + [window_length] + (additional_windows or [])))
+
+    @property
+    def slot_name(self):
+        """Name of the shared memory segment that the worker publishes the status to"""
+        return self._slot.name
+
+    def notify_listeners(self):
+        """Calls the listeners after the worker has published a new snapshot"""
+        for callback in self._listeners:
+            callback()
+
+    def add_listener(self, callback):
+        """Registers a function that is called (with no arguments) whenever a new status version is published"""
+        self._listeners.append(callback)
+
+    def _read_slot(self):
+        """Returns the latest value published by the worker, or the last value that was read if it has exited"""
+        return self._slot.read() if self._worker.alive else self._slot.value
+
+    def snapshot(self):
+        """
+        Returns the latest StatusSnapshot published by the worker. If the worker has exited, or has not
+        republished an expired snapshot within WORKER_REFRESH_GRACE seconds (e.g. because it has hung),
+        a copy of the snapshot where none of the parameters have current data is returned instead
+        """
+        value = self._read_slot()
+        if value is None:
+            return StatusSnapshot(0, None, None, -math.inf, None, None, None)
+
+        published, snapshot, no_data = self._snapshots
+        if value[0] is not published:
+            published = value[0]
+            snapshot = published._replace(version=2 * published.version,
+                                          valid_until=published.valid_until + WORKER_REFRESH_GRACE)
+            no_data = None
+            self._snapshots = (published, snapshot, no_data)
+
+        if self._worker.alive and time.time() <= snapshot.valid_until:
+            return snapshot
+
+        if no_data is None:
+            if self._worker.alive:
+                print(f'{datetime.datetime.utcnow()} WARNING: {self._worker.name} has not refreshed the ' +
+                      f'status of {self.daemon_name}')
+
+            no_data = self._no_data_snapshot(published)
+            self._snapshots = (published, snapshot, no_data)
+
+        return no_data
+
+    def _no_data_snapshot(self, snapshot):
+        """Returns a copy of a snapshot where none of the parameters have current data"""
+        safety = None
+        if snapshot.epoch_status is not None:
+            safety_parameters = {p.name for p in self._parameters if p.affects_safety}
+            safety = tuple((name, 'unsafe' if summary['unsafe'] else 'no data')
+                           for name, summary in snapshot.epoch_status['parameters'].items()
+                           if name in safety_parameters)
+
+        def no_data_windows(windows):
+            return None if windows is None else {k: _no_data_status(v) for k, v in windows.items()}
+
+        return StatusSnapshot(2 * snapshot.version + 1, _no_data_status(snapshot.status),
+                              no_data_windows(snapshot.windows), math.inf, _no_data_status(snapshot.epoch_status),
+                              no_data_windows(snapshot.epoch_windows), safety)
+
+    def latest_measurement(self):
+        """Returns a (unix timestamp, measurement dictionary) tuple for the most recently
+           received measurement, or None if there is no data. The dictionary must not be modified"""
+        value = self._read_slot()
+        return None if value is None else value[1]
+
+    @property
+    def version(self):
+        """Version number of the latest status snapshot"""
+        return self.snapshot().version
+
+    @property
+    def window_lengths(self):
+        """Sorted list of the window lengths that can be passed to status()"""
+        return self._window_lengths
+
+    def schema(self):
+        """Returns the static metadata for the watcher and its parameters (see AggregateParameter.schema)"""
+        return {
+            'name': self.daemon_name,
+            'label': self._label,
+            'parameters': [p.schema() for p in self._parameters]
+        }
+
+    def status(self, window=None, epoch_dates=False):
+        """Queries the aggregate status of the monitored daemon (see PyroWatcher.status)"""
+        snapshot = self.snapshot()
+        if window is None:
+            return snapshot.epoch_status if epoch_dates else snapshot.status
+
+        windows = snapshot.epoch_windows if epoch_dates else snapshot.windows
+        if window not in windows:
+            raise ValueError(f'window length {window} is not configured for {self.daemon_name}')
+        return windows[window]
+
+    def history(self, parameter, start, end, resolution):
+        """Returns downsampled history for a parameter (see PyroWatcher.history)"""
+        return self._worker.call('history', self.daemon_name, parameter, start, end, resolution)
+
+    def clear_history(self):
+        """Clears the measurements held by the worker"""
+        self._worker.call('clear_history', self.daemon_name)
+
+    def reconfigure(self, label, max_data_gap, window_length, parameters, additional_windows=None):
+        """Replaces the parameter definitions without discarding the buffered measurements"""
+        self._worker.call('reconfigure', self.daemon_name, label, max_data_gap, window_length,
+                          parameters, additional_windows)
+        self._set_parameters(label, window_length, parameters, additional_windows)
+
+    def close(self):
+        """Stops the watcher in the worker process and releases the shared memory"""
+        if self._registered.get(self.daemon_name) is self:
+            del self._registered[self.daemon_name]
+        self._worker.watchers.discard(self.daemon_name)
+
+        try:
+            self._worker.call('remove', self.daemon_name)
+        except Exception as exception:
+            print(f'{datetime.datetime.utcnow()} ERROR: failed to stop {self.daemon_name}: {exception}')
+
+        self.release()
+
+    def release(self):
+        """Removes the shared memory segment. snapshot() continues to return the last published status"""
+        self._slot.close()
+
+
+def _run_worker(connection, events, max_concurrent_queries, persistent_connections):
+    """Main loop of a worker process: runs the watchers sent by the front-end and answers its commands"""
+    scheduler = PollScheduler(max_concurrent_queries)
+    scheduler.start()
+    proxy_pool = ProxyPool() if persistent_connections else None
+
+    # (PyroWatcher, SnapshotSlot) keyed by name
+    watchers = {}
+
+    def add(slot_name, name, daemon, method, label, query_delay, max_data_gap, window_length, parameters,
+            log_name, additional_windows, history_path, min_query_delay, max_query_delay):
+        watcher = PyroWatcher(name, getattr(daemons, daemon), method, label, query_delay, max_data_gap,
+                              window_length, parameters, log_name, proxy_pool, additional_windows, history_path,
+                              min_query_delay, max_query_delay)
+        slot = SnapshotSlot(slot_name)
+
+        def publish():
+            # Called with the watcher lock held, so snapshot() returns the new snapshot without blocking
+            try:
+                slot.write((watcher.snapshot(), watcher.latest_measurement()))
+            except Exception as exception:
+                print(f'{datetime.datetime.utcnow()} ERROR: failed to publish {name}: {exception}')
+                return
+            events.put(name)
+
+        watcher.add_listener(publish)
+        watchers[name] = (watcher, slot)
+
+        try:
+            restored = watcher.load_history()
+            if restored:
+                print(f'Restored {restored} measurements for {name}')
+        except Exception as exception:
+            print(f'ERROR: failed to restore history for {name}: {exception}')
+
+        watcher.refresh()
+        scheduler.add(watcher)
+
+    def remove(name):
+        watcher, slot = watchers.pop(name)
+        scheduler.remove(watcher)
+        watcher.close()
+        slot.close()
+
+    commands = {
+        'add': add,
+        'remove': remove,
+        'reconfigure': lambda name, *args: watchers[name][0].reconfigure(*args),
+        'history': lambda name, *args: watchers[name][0].history(*args),
+        'clear_history': lambda name: watchers[name][0].clear_history(),
+        'metrics': registry.to_dict,
+        'poll_statistics': scheduler.statistics,
+    }
+
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            # The front-end has exited
+            return
+
+        try:
+            connection.send((True, commands[command](*args)))
+        except Exception as exception:
+            connection.send((False, f'{command} failed: {exception}'))
@@ -0,0 +1,93 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the aggregate parameter safety flags"""
+
+import random
+import statistics
+import pytest
+from rockit.environment.aggregate_parameter import AggregateBehaviour, AggregateParameter
+from rockit.environment.measurement_buffer import MeasurementBuffer
+
+BEHAVIOURS = [AggregateBehaviour.Range, AggregateBehaviour.Median, AggregateBehaviour.Latest,
+              AggregateBehaviour.Set, AggregateBehaviour.LatestSet]
+
+
+def _outside(low, high, limits):
+    return bool(limits) and (low < limits[0] or high > limits[1])
+
+
+def reference_flags(window, current, limits, warn_limits, valid_set_values, behaviour):
+    """The unsafe and warning flags as they were calculated inline by summarise before limit_flags was added"""
+    values = [v for _, v in window.measurements()]
+    if behaviour in (AggregateBehaviour.Set, AggregateBehaviour.LatestSet):
+        checked = values if behaviour == AggregateBehaviour.Set else values[-1:]
+        invalid = bool(valid_set_values) and any(v not in valid_set_values for v in checked)
+        return invalid, invalid
+
+    if behaviour == AggregateBehaviour.Range:
+        low, high = min(values), max(values)
+    elif behaviour == AggregateBehaviour.Median:
+        low = high = statistics.median(values)
+    elif current:
+        low = high = values[-1]
+    else:
+        return False, False
+
+    return _outside(low, high, limits), _outside(low, high, warn_limits)
+
+
+@pytest.mark.parametrize('behaviour', BEHAVIOURS)
+def test_limit_flags_match_reference(behaviour):
+    rnd = random.Random(behaviour)
+    for _ in range(500):
+        limits = sorted([rnd.uniform(-1, 0.5), rnd.uniform(-0.5, 1)]) if rnd.random() < 0.7 else None
+        warn_limits = sorted([rnd.uniform(-1, 0.5), rnd.uniform(-0.5, 1)]) if rnd.random() < 0.7 else None
+        valid_set_values = rnd.sample(range(4), rnd.randrange(1, 4)) if rnd.random() < 0.7 else None
+        parameter = AggregateParameter('x', behaviour, 'X', limits=limits, warn_limits=warn_limits,
+                                       valid_set_values=valid_set_values)
+
+        buffer = MeasurementBuffer(['x'])
+        window = parameter.create_window(buffer)
+        sequences = []
+        for timestamp in range(rnd.randrange(1, 20)):
+            if behaviour in (AggregateBehaviour.Set, AggregateBehaviour.LatestSet):
+                value = rnd.randrange(4)
+            else:
+                value = rnd.uniform(-1.5, 1.5)
+            sequences.append(buffer.append(timestamp, {'x': value}))
+            window.append(sequences[-1])
+
+            # Slide the window so that the incrementally maintained aggregates are also checked after expiry
+            if rnd.random() < 0.3:
+                window.expire(sequences[rnd.randrange(len(sequences))])
+
+            for current in [True, False]:
+                expected = reference_flags(window, current, limits, warn_limits, valid_set_values, behaviour)
+                assert parameter.limit_flags(window, current) == expected
+
+                summary = parameter.summarise(window, -1 if current else 100)
+                assert (summary['unsafe'], summary['warning']) == expected
+
+
+def test_latest_ignores_stale_measurements():
+    parameter = AggregateParameter('x', AggregateBehaviour.Latest, 'X', limits=[0, 1], warn_limits=[0.2, 0.8])
+    buffer = MeasurementBuffer(['x'])
+    window = parameter.create_window(buffer)
+    window.append(buffer.append(0, {'x': 5}))
+
+    assert parameter.limit_flags(window, True) == (True, True)
+    assert parameter.limit_flags(window, False) == (False, False)
@@ -0,0 +1,53 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the status deltas reported to waiting clients"""
+
+from rockit.environment.change_notifier import ChangeNotifier, status_delta
+
+
+def _parameter(unsafe=False, latest=1):
+    return {'label': 'X', 'unsafe': unsafe, 'warning': False, 'current': True, 'latest': latest, 'date_count': 1}
+
+
+def test_delta_reports_changed_and_added_parameters():
+    old = {'a': {'parameters': {'x': _parameter(), 'y': _parameter()}}}
+    new = {'a': {'parameters': {'x': _parameter(unsafe=True), 'y': _parameter(), 'z': _parameter(latest=2)}}}
+    assert status_delta(old, new) == {
+        'a': {
+            'x': {'unsafe': True, 'warning': False, 'current': True, 'latest': 1},
+            'z': {'unsafe': False, 'warning': False, 'current': True, 'latest': 2}
+        }
+    }
+
+
+def test_delta_reports_removals():
+    old = {
+        'a': {'parameters': {'x': _parameter(), 'y': _parameter()}},
+        'b': {'parameters': {'x': _parameter()}}
+    }
+    new = {'a': {'parameters': {'x': _parameter()}}}
+    assert status_delta(old, new) == {'a': {'y': None}, 'b': None}
+
+
+def test_unknown_version_returns_full_status():
+    notifier = ChangeNotifier(history_length=2)
+    status = {'a': {'parameters': {'x': _parameter()}}}
+    for version in range(3):
+        notifier.record(version, status)
+
+    assert notifier.delta(0, 3, status) == {'version': 3, 'status': status}
+    assert notifier.delta(2, 3, status) == {'version': 3, 'changes': {}}
@@ -0,0 +1,80 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the compact status encoding"""
+
+from rockit.environment.compact_status import apply_status_changes, decode_status, encode_parameter, \
+    encode_status, status_changes, FLAG_CURRENT, FLAG_UNSAFE
+
+SCHEMA = {
+    'version': 1,
+    'watchers': [{
+        'name': 'vaisala',
+        'label': 'Vaisala',
+        'parameters': [
+            {'name': 'wind', 'type': 'Range', 'label': 'Wind', 'unit': 'km/h', 'limits': [0, 40]},
+            {'name': 'rain', 'type': 'Set', 'label': 'Rain', 'valid_values': [False]},
+            {'name': 'pressure', 'type': 'Latest', 'label': 'Pressure'}
+        ]
+    }]
+}
+
+
+def _status(wind_max, rain_values, pressure_count=1):
+    pressure = {'label': 'Pressure', 'unsafe': False, 'warning': False, 'current': bool(pressure_count),
+                'date_start': 100 if pressure_count else None, 'date_end': 110 if pressure_count else None,
+                'date_count': pressure_count}
+    if pressure_count:
+        pressure['latest'] = 800
+
+    return {
+        'vaisala': {
+            'label': 'Vaisala',
+            'parameters': {
+                'wind': {'label': 'Wind', 'unsafe': wind_max > 40, 'warning': False, 'current': True,
+                         'date_start': 100, 'date_end': 110, 'date_count': 2, 'unit': 'km/h', 'limits': [0, 40],
+                         'latest': wind_max, 'min': 1, 'max': wind_max},
+                'rain': {'label': 'Rain', 'unsafe': True in rain_values, 'warning': True in rain_values,
+                         'current': True, 'date_start': 100, 'date_end': 110, 'date_count': 2,
+                         'latest': rain_values[-1], 'values': rain_values, 'valid_values': [False]},
+                'pressure': pressure
+            }
+        }
+    }
+
+
+def test_encode_parameter_drops_trailing_none():
+    status = _status(50, [False], pressure_count=0)
+    assert encode_parameter(status['vaisala']['parameters']['wind']) == \
+        [FLAG_UNSAFE | FLAG_CURRENT, 100, 110, 2, 50, 1, 50]
+    assert encode_parameter(status['vaisala']['parameters']['pressure']) == [0, None, None, 0]
+
+
+def test_round_trip():
+    for status in [_status(10, [False]), _status(50, [False, True], pressure_count=0)]:
+        assert decode_status(SCHEMA, encode_status(status)) == status
+
+
+def test_changes_update_only_modified_rows():
+    old = encode_status(_status(10, [False]))
+    new = encode_status(_status(50, [False]))
+    changes = status_changes(old, new)
+    assert [(i, j) for i, j, _ in changes] == [(0, 0)]
+
+    updated = apply_status_changes(old, changes)
+    assert updated == new
+    assert old == encode_status(_status(10, [False])), 'apply_status_changes must not modify its input'
+    assert not status_changes(new, new)
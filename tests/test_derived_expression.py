@@ -0,0 +1,63 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the derived parameter expressions"""
+
+import math
+import pytest
+from rockit.environment.derived_watcher import DerivedExpression
+
+WATCHERS = ['vaisala', 'cloudwatcher']
+
+
+def test_evaluates_fields_and_functions():
+    expression = DerivedExpression('vaisala.temperature - vaisala.dew_point', WATCHERS)
+    assert expression.watchers == ['vaisala']
+    assert expression.evaluate({'vaisala': {'temperature': 10, 'dew_point': 4}}) == 6
+
+    expression = DerivedExpression('max(abs(vaisala.t), sqrt(cloudwatcher.sky)) if vaisala.ok else -1', WATCHERS)
+    assert expression.watchers == ['cloudwatcher', 'vaisala']
+    assert expression.evaluate({'vaisala': {'t': -2, 'ok': True}, 'cloudwatcher': {'sky': 9}}) == 3
+    assert expression.evaluate({'vaisala': {'t': -2, 'ok': False}, 'cloudwatcher': {'sky': 9}}) == -1
+
+
+def test_missing_or_invalid_inputs_return_none():
+    expression = DerivedExpression('log(vaisala.x) + cloudwatcher.y', WATCHERS)
+    assert expression.evaluate({'vaisala': {'x': 1}}) is None
+    assert expression.evaluate({'vaisala': {}, 'cloudwatcher': {'y': 1}}) is None
+    assert expression.evaluate({'vaisala': {'x': 0}, 'cloudwatcher': {'y': 1}}) is None
+    assert expression.evaluate({'vaisala': {'x': 'a'}, 'cloudwatcher': {'y': 1}}) is None
+    assert math.isclose(expression.evaluate({'vaisala': {'x': math.e}, 'cloudwatcher': {'y': 1}}), 2)
+
+
+@pytest.mark.parametrize('source', [
+    'vaisala.x +',                          # syntax error
+    '__import__("os")',                     # unknown function
+    'open("/etc/passwd")',                  # unknown function
+    'vaisala.x.__class__',                  # attribute of a field
+    'vaisala.__class__',                    # private field name
+    'unknown.x',                            # unknown watcher
+    'vaisala',                              # bare watcher name
+    'x',                                    # unknown name
+    '[v for v in vaisala.x]',               # comprehension
+    'lambda: 1',                            # lambda
+    'vaisala.x[0]',                         # subscript
+    'max(vaisala.x, key=abs)',              # keyword arguments
+    'abs.__call__(1)',                      # method call
+])
+def test_rejects_unsafe_syntax(source):
+    with pytest.raises(ValueError):
+        DerivedExpression(source, WATCHERS)
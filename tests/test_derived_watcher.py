@@ -0,0 +1,129 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the evaluation and aggregation of derived parameters"""
+
+import time
+from rockit.environment.aggregate_parameter import AggregateBehaviour, AggregateParameter
+from rockit.environment.derived_watcher import DerivedExpression, DerivedWatcher
+
+
+class FakeWatcher:
+    """Input watcher that returns a fixed latest measurement"""
+    def __init__(self, timestamp=None, measurement=None):
+        self.latest = None
+        if timestamp is not None:
+            self.latest = (timestamp, measurement)
+
+    def latest_measurement(self):
+        return self.latest
+
+
+def create_watcher(sources, expressions):
+    names = list(expressions)
+    parameters = [AggregateParameter(n, AggregateBehaviour.Latest, n, limits=[0, 100]) for n in names]
+    watcher = DerivedWatcher('derived', 'Derived', 10, 30, 3600, parameters,
+                             [DerivedExpression(expressions[n], sources) for n in names], 'test')
+    watcher.set_sources(sources)
+    return watcher
+
+
+def parameter_status(watcher, name):
+    return watcher.status(epoch_dates=True)['parameters'][name]
+
+
+def test_values_take_the_timestamp_of_their_oldest_input():
+    now = int(time.time())
+    sources = {'a': FakeWatcher(now - 5, {'t': 5}), 'b': FakeWatcher(now - 10, {'t': 2})}
+    watcher = create_watcher(sources, {'sum': 'a.t + b.t'})
+    watcher.poll()
+
+    status = parameter_status(watcher, 'sum')
+    assert status['latest'] == 7
+    assert status['date_end'] == now - 10
+    assert status['current']
+
+    # Values are only re-evaluated when an input changes
+    watcher.poll()
+    assert parameter_status(watcher, 'sum')['date_count'] == 1
+
+
+def test_stale_inputs_are_not_current():
+    now = int(time.time())
+    sources = {'a': FakeWatcher(now, {'t': 1}), 'b': FakeWatcher()}
+    watcher = create_watcher(sources, {'fresh': 'a.t', 'double': 'b.t * 2'})
+    watcher.poll()
+
+    # A value calculated from an old input is not moved forward to the time of the newer values
+    sources['b'].latest = (now - 300, {'t': 5})
+    watcher.poll()
+
+    status = parameter_status(watcher, 'double')
+    assert status['latest'] == 10
+    assert status['date_end'] == now - 300
+    assert not status['current']
+
+
+def test_parameters_are_independent():
+    now = int(time.time())
+    sources = {'a': FakeWatcher(now - 300, {'t': 5}), 'b': FakeWatcher(now, {'t': 1})}
+    watcher = create_watcher(sources, {'old': 'a.t', 'new': 'b.t'})
+    watcher.poll()
+
+    assert not parameter_status(watcher, 'old')['current']
+    assert parameter_status(watcher, 'new')['current']
+    assert parameter_status(watcher, 'new')['date_end'] == now
+
+    # A newer input for one parameter doesn't change the timestamps of the other
+    sources['b'].latest = (now + 1, {'t': 2})
+    watcher.poll()
+    old = parameter_status(watcher, 'old')
+    assert old['date_count'] == 1
+    assert old['date_end'] == now - 300
+    assert parameter_status(watcher, 'new')['date_count'] == 2
+
+    # An older input than the previous value of the other parameter is still accepted
+    sources['a'].latest = (now - 5, {'t': 6})
+    watcher.poll()
+    old = parameter_status(watcher, 'old')
+    assert old['current']
+    assert old['latest'] == 6
+    assert old['date_end'] == now - 5
+
+
+def test_missing_inputs_are_not_evaluated():
+    now = int(time.time())
+    sources = {'a': FakeWatcher(now, {'t': 5}), 'b': FakeWatcher()}
+    watcher = create_watcher(sources, {'sum': 'a.t + b.t', 'a': 'a.t'})
+    watcher.poll()
+
+    assert parameter_status(watcher, 'sum')['date_count'] == 0
+    assert parameter_status(watcher, 'a')['latest'] == 5
+
+
+def test_input_clock_reset():
+    now = int(time.time())
+    sources = {'a': FakeWatcher(now, {'t': 5})}
+    watcher = create_watcher(sources, {'t': 'a.t'})
+    watcher.poll()
+
+    sources['a'].latest = (now - 600, {'t': 6})
+    watcher.poll()
+
+    status = parameter_status(watcher, 't')
+    assert status['latest'] == 6
+    assert status['date_count'] == 1
+    assert not status['current']
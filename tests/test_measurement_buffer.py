@@ -0,0 +1,79 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the columnar measurement buffer"""
+
+import pytest
+from rockit.environment.measurement_buffer import MeasurementBuffer
+
+
+def test_values_keep_their_type():
+    buffer = MeasurementBuffer(['count', 'speed', 'state'])
+    first = buffer.append(0, {'count': 1, 'speed': 1.5, 'state': True})
+    second = buffer.append(1, {'count': 2, 'speed': 2, 'state': 'open'})
+
+    assert buffer.value('count', first) == 1 and isinstance(buffer.value('count', first), int)
+    assert buffer.value('speed', second) == 2.0 and isinstance(buffer.value('speed', second), float)
+
+    # A non-numeric value converts the column to interned values, keeping the earlier bool distinct from 1
+    assert buffer.value('state', first) is True
+    assert buffer.value('state', second) == 'open'
+
+
+def test_missing_fields():
+    buffer = MeasurementBuffer(['a', 'b'])
+    sequence = buffer.append(10, {'a': 1, 'ignored': 2})
+    assert buffer.value('b', sequence) is None
+    assert buffer.row(sequence) == {'date': 10, 'a': 1}
+
+
+def test_interned_column_grows_past_256_values():
+    buffer = MeasurementBuffer(['name'])
+    sequences = [buffer.append(i, {'name': f'value{i}'}) for i in range(300)]
+    assert [buffer.value('name', s) for s in sequences] == [f'value{i}' for i in range(300)]
+
+
+def test_find_and_discard():
+    buffer = MeasurementBuffer(['x'])
+    for i in range(200):
+        buffer.append(i * 10, {'x': i})
+
+    # Repeated timestamps are allowed, and find returns the first of them
+    repeated = buffer.append(1990, {'x': 199})
+    assert buffer.find(1990) == repeated - 1
+    assert buffer.find(55) == 6
+    assert buffer.find(5000) == buffer.end
+
+    buffer.discard(150)
+    assert buffer.start == 150
+    assert len(buffer) == buffer.end - 150
+    assert buffer.value('x', 150) == 150
+    assert buffer.find(0) == 150
+
+    buffer.clear()
+    assert len(buffer) == 0
+
+
+def test_rejects_out_of_order_timestamps():
+    buffer = MeasurementBuffer(['x'])
+    buffer.append(100, {'x': 1})
+    with pytest.raises(ValueError):
+        buffer.append(99, {'x': 2})
+
+    # Any timestamp is accepted once the buffer is empty
+    buffer.clear()
+    sequence = buffer.append(50, {'x': 3})
+    assert buffer.find(0) == sequence
@@ -0,0 +1,202 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the measurement handling of PyroWatcher"""
+
+# pylint: disable=protected-access
+
+import time
+import Pyro4
+import pytest
+from rockit.environment import pyro_watcher
+from rockit.environment.aggregate_parameter import AggregateBehaviour, AggregateParameter
+from rockit.environment.measurement_log import MeasurementLog
+from rockit.environment.pyro_watcher import MAX_CLOCK_SKEW, PyroWatcher, poll_batch
+from rockit.environment.timestamps import format_timestamp
+
+YEAR = 365 * 86400
+
+
+def create_watcher(history_path=None, name='test', daemon=None, method='last_measurement'):
+    parameters = [AggregateParameter('wind', AggregateBehaviour.Range, 'Wind', limits=[0, 40])]
+    return PyroWatcher(name, daemon, method, 'Test', 10, 30, 3600, parameters, 'test',
+                       history_path=history_path)
+
+
+def measurement(timestamp, wind):
+    return {'date': format_timestamp(timestamp), 'wind': wind}
+
+
+def wind_status(watcher):
+    return watcher.status(epoch_dates=True)['parameters']['wind']
+
+
+def test_future_measurements_are_discarded():
+    watcher = create_watcher()
+    now = time.time()
+    watcher._process(measurement(now - 10, 5))
+
+    # A sensor with a bad clock must not freeze the status on its reading
+    watcher._process(measurement(now + YEAR, 50))
+    status = wind_status(watcher)
+    assert status['latest'] == 5
+    assert not status['unsafe']
+
+    # Correctly dated measurements are still accepted
+    watcher._process(measurement(now, 10))
+    status = wind_status(watcher)
+    assert status['current']
+    assert status['latest'] == 10
+    assert status['date_count'] == 2
+
+
+def test_small_backwards_steps_are_discarded():
+    watcher = create_watcher()
+    now = time.time()
+    watcher._process(measurement(now, 5))
+    watcher._process(measurement(now - MAX_CLOCK_SKEW / 2, 10))
+    watcher._process(measurement(now, 15))
+
+    status = wind_status(watcher)
+    assert status['latest'] == 15
+    assert status['min'] == 5
+    assert status['date_count'] == 2
+
+
+def test_clock_reset_discards_earlier_measurements():
+    watcher = create_watcher()
+    now = time.time()
+    watcher._process(measurement(now + MAX_CLOCK_SKEW / 2, 50))
+    watcher._process(measurement(now - 2 * MAX_CLOCK_SKEW, 5))
+    watcher._process(measurement(now - 5, 10))
+
+    status = wind_status(watcher)
+    assert status['current']
+    assert not status['unsafe']
+    assert status['max'] == 10
+    assert status['date_count'] == 2
+
+
+def test_future_measurements_are_not_restored(tmp_path):
+    now = time.time()
+    # A long retention stops the log compacting away the earlier measurement
+    history = MeasurementLog(str(tmp_path / 'test.log'), ['wind'], 2 * YEAR)
+    history.append(now - 20, {'wind': 5})
+    history.append(now + YEAR, {'wind': 50})
+    history.close()
+
+    watcher = create_watcher(str(tmp_path))
+    assert watcher.load_history() == 1
+    assert wind_status(watcher)['latest'] == 5
+
+    watcher._process(measurement(now, 10))
+    status = wind_status(watcher)
+    assert status['latest'] == 10
+    assert status['date_count'] == 2
+    watcher.close()
+
+    # The future measurement is also removed from the log
+    assert [r[1]['wind'] for r in MeasurementLog(str(tmp_path / 'test.log'), ['wind'], 3600).read(0)] == [5, 10]
+
+
+class FakeProxy:
+    """Proxy for a FakeDaemon, with methods that return a measurement or raise the given exception"""
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._daemon.exit_error is not None:
+            raise self._daemon.exit_error
+
+    def __getattr__(self, method):
+        def call():
+            error = self._daemon.errors.get(method)
+            if error is not None:
+                raise error
+            return measurement(time.time(), 10)
+        return call
+
+
+class FakeDaemon:
+    """Daemon entry that counts its connections"""
+    def __init__(self, errors=None, exit_error=None):
+        self.errors = errors or {}
+        self.exit_error = exit_error
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        return FakeProxy(self)
+
+
+class FakeBatch:
+    """Batch proxy that makes the queued calls in order, stopping at the first call that raises"""
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def __getattr__(self, method):
+        return lambda: self._calls.append(method)
+
+    def __call__(self):
+        for method in self._calls:
+            yield getattr(self._proxy, method)()
+
+
+@pytest.fixture(name='fake_batch')
+def fixture_fake_batch(monkeypatch):
+    monkeypatch.setattr(pyro_watcher.Pyro4, 'batch', FakeBatch, raising=False)
+
+
+def create_batch(daemon):
+    return [create_watcher(name=f'test{i}', daemon=daemon, method=f'method{i}') for i in range(3)]
+
+
+@pytest.mark.usefixtures('fake_batch')
+def test_batch_connection_error_fails_all_watchers():
+    error = Pyro4.errors.CommunicationError('host unreachable')
+    daemon = FakeDaemon(errors={'method0': error})
+    watchers = create_batch(daemon)
+    poll_batch(watchers)
+
+    # The remaining watchers are not queried individually
+    assert daemon.connections == 1
+    assert all(w._last_query_failed for w in watchers)
+
+
+@pytest.mark.usefixtures('fake_batch')
+def test_batch_remote_error_polls_remaining_watchers():
+    daemon = FakeDaemon(errors={'method1': ValueError('sensor error')})
+    watchers = create_batch(daemon)
+    poll_batch(watchers)
+
+    assert daemon.connections == 2
+    assert [w._last_query_failed for w in watchers] == [False, True, False]
+    assert wind_status(watchers[0])['current']
+    assert wind_status(watchers[2])['current']
+
+
+@pytest.mark.usefixtures('fake_batch')
+def test_batch_error_after_all_results():
+    daemon = FakeDaemon(exit_error=Pyro4.errors.ConnectionClosedError('closed'))
+    watchers = create_batch(daemon)
+    poll_batch(watchers)
+
+    assert daemon.connections == 1
+    assert all(wind_status(w)['current'] and not w._last_query_failed for w in watchers)
@@ -0,0 +1,47 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the date string conversions"""
+
+import calendar
+import datetime
+import pytest
+from rockit.environment.timestamps import DATE_FORMAT, format_timestamp, parse_timestamp
+
+
+@pytest.mark.parametrize('date', ['2024-01-01T00:00:00Z', '2024-02-29T23:59:59Z', '1999-12-31T12:34:56Z'])
+def test_parse_matches_strptime(date):
+    expected = calendar.timegm(datetime.datetime.strptime(date, DATE_FORMAT).timetuple())
+    assert parse_timestamp(date) == expected
+
+
+@pytest.mark.parametrize('date', ['2024-01-01 00:00:00Z', '2024-01-01T00:00:00', '2024-01-01T24:00:00Z',
+                                  '2024-01-01T00:60:00Z', '2024-13-01T00:00:00Z', '', '2024-01-01T-1:00:00Z',
+                                  '2024-01-01T+1:-5:00Z', '2024-01-01T 1:00:00Z', '2024-01-01T01:00:+5Z',
+                                  '2024-01-01T01:00:٠٥Z'])
+def test_parse_rejects_invalid_dates(date):
+    with pytest.raises(ValueError):
+        parse_timestamp(date)
+
+
+def test_format_round_trip():
+    for timestamp in [0, 951782400, 1704067199, 1704067200 + 86399]:
+        assert parse_timestamp(format_timestamp(timestamp)) == timestamp
+        assert format_timestamp(timestamp) == datetime.datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT)
+
+
+def test_format_truncates_fractional_seconds():
+    assert format_timestamp(1704067200.999) == '2024-01-01T00:00:00Z'
@@ -0,0 +1,169 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the worker process pool and its shared memory snapshot slots"""
+
+# pylint: disable=protected-access
+
+import threading
+import time
+import pytest
+from rockit.environment.aggregate_parameter import AggregateBehaviour, AggregateParameter
+from rockit.environment.measurement_log import MeasurementLog
+from rockit.environment.worker_pool import SLOT_HEADER, SLOT_READ_TIMEOUT, SnapshotSlot, WorkerPool
+
+
+def test_slot_round_trip():
+    writer = SnapshotSlot()
+    reader = SnapshotSlot(writer.name)
+    try:
+        assert reader.read() is None
+
+        writer.write({'version': 1})
+        value = reader.read()
+        assert value == {'version': 1}
+
+        # Unchanged slots return the previously decoded value
+        assert reader.read() is value
+
+        writer.write({'version': 2})
+        assert reader.read() == {'version': 2}
+    finally:
+        reader.close()
+        writer.close()
+
+    # The last value is still returned after the slot is closed
+    assert reader.read() == {'version': 2}
+
+
+def test_slot_reader_waits_for_write_to_finish():
+    writer = SnapshotSlot()
+    reader = SnapshotSlot(writer.name)
+    try:
+        writer.write('first')
+        assert reader.read() == 'first'
+
+        # Simulate a write that is in progress by setting an odd sequence number
+        buf = writer._memory.buf
+        sequence, length = SLOT_HEADER.unpack_from(buf, 0)
+        SLOT_HEADER.pack_into(buf, 0, sequence + 1, length)
+
+        def finish():
+            time.sleep(0.1)
+            SLOT_HEADER.pack_into(buf, 0, sequence, length)
+            writer.write('second')
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        assert reader.read() == 'second'
+        thread.join()
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_slot_reader_gives_up_on_unfinished_write():
+    writer = SnapshotSlot()
+    reader = SnapshotSlot(writer.name)
+    try:
+        writer.write('first')
+        assert reader.read() == 'first'
+
+        # Simulate a writer that was killed part-way through a write
+        buf = writer._memory.buf
+        sequence, length = SLOT_HEADER.unpack_from(buf, 0)
+        SLOT_HEADER.pack_into(buf, 0, sequence + 1, length)
+
+        start = time.monotonic()
+        assert reader.read() == 'first'
+        assert time.monotonic() - start < SLOT_READ_TIMEOUT + 1
+
+        # The reader doesn't wait for the same write again
+        start = time.monotonic()
+        assert reader.read() == 'first'
+        assert time.monotonic() - start < SLOT_READ_TIMEOUT
+
+        SLOT_HEADER.pack_into(buf, 0, sequence, length)
+        writer.write('second')
+        assert reader.read() == 'second'
+    finally:
+        reader.close()
+        writer.close()
+
+
+def _wait_for(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.05)
+
+
+def test_killed_worker_reports_no_data(tmp_path):
+    # Restore a recent measurement from the history so that the watcher has current data without a sensor
+    history = MeasurementLog(str(tmp_path / 'test.log'), ['wind'], 600)
+    history.append(time.time(), {'wind': 10})
+    history.close()
+
+    parameters = [AggregateParameter('wind', AggregateBehaviour.Range, 'Wind', limits=[0, 40])]
+    pool = WorkerPool(1, 1, False, 'test')
+    try:
+        watcher = pool.create_watcher('test', 'onemetre_vaisala', 'last_measurement', 'Test', 600, 600, 60,
+                                      parameters, 'test', history_path=str(tmp_path))
+
+        _wait_for(lambda: watcher.snapshot().safety == ())
+        published = watcher.snapshot()
+        assert published.status['parameters']['wind']['current']
+
+        notified = threading.Event()
+        watcher.add_listener(notified.set)
+
+        pool._workers[0]._process.kill()
+        assert notified.wait(10), 'listeners were not notified that the worker exited'
+
+        snapshot = watcher.snapshot()
+        assert snapshot.version > published.version
+        assert snapshot.safety == (('wind', 'no data'),)
+        assert not snapshot.status['parameters']['wind']['current']
+        assert not snapshot.epoch_windows[60]['parameters']['wind']['current']
+        assert snapshot.status['parameters']['wind']['latest'] == 10
+
+        # Commands sent to the dead worker fail rather than block
+        assert pool.metrics() == []
+    finally:
+        pool._release()
+
+
+def test_watchers_are_not_assigned_to_dead_workers():
+    parameters = [AggregateParameter('wind', AggregateBehaviour.Range, 'Wind', limits=[0, 40])]
+    pool = WorkerPool(2, 1, False, 'test')
+    try:
+        pool._workers[0]._process.kill()
+        _wait_for(lambda: not pool._workers[0].alive)
+
+        for name in ['a', 'b']:
+            pool.create_watcher(name, 'onemetre_vaisala', 'last_measurement', 'Test', 600, 600, 60,
+                                parameters, 'test')
+
+        assert pool._workers[0].watchers == set()
+        assert pool._workers[1].watchers == {'a', 'b'}
+
+        pool._workers[1]._process.kill()
+        _wait_for(lambda: not pool._workers[1].alive)
+        with pytest.raises(RuntimeError):
+            pool.create_watcher('c', 'onemetre_vaisala', 'last_measurement', 'Test', 600, 600, 60,
+                                parameters, 'test')
+    finally:
+        pool._release()